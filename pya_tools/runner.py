@@ -17,6 +17,9 @@ import importlib.resources as resources
 import shutil
 from pathlib import Path
 import os
+import re
+import glob
+import json
 
 # ------------------------
 # functions
@@ -52,6 +55,126 @@ def copy_config_dir(pya_name: str, dest_dir: Path):
     print(f"Error copying config: {e}")
 
 
+def merge_lef_shards(out_lef: str) -> int:
+  """
+  pya_gds2lef(-rd shard=i/N)の出力(<out_lef>.head, <out_lef>.shard<i>of<N>)を
+  1つのLEFへまとめる。MACROは1ノードで実行した場合と同じ順に並べる。
+  """
+  head_file = f"{out_lef}.head"
+  frag_files = sorted(glob.glob(glob.escape(out_lef) + ".shard*of*"))
+
+  if not os.path.isfile(head_file):
+    print(f"[ERR]: {head_file} is not found (written by shard 1).")
+    return 1
+  if not frag_files:
+    print(f"[ERR]: no fragment files ({out_lef}.shard<i>of<N>) are found.")
+    return 1
+
+  marker = re.compile(r"#@pya_gds2lef macro (\d+) (\d+) (\S+)\n")
+  blocks = {}
+  totals = set()
+  for frag_file in frag_files:
+    with open(frag_file, "r", encoding="utf-8") as f:
+      text = f.read()
+    parts = marker.split(text)
+    for i in range(1, len(parts), 4):
+      order, total, name, block = int(parts[i]), int(parts[i+1]), parts[i+2], parts[i+3]
+      if order in blocks:
+        print(f"[ERR]: MACRO {name} is duplicated in {frag_file}.")
+        return 1
+      blocks[order] = block
+      totals.add(total)
+
+  if len(totals) > 1:
+    print(f"[ERR]: fragment files are from different runs (total macros={sorted(totals)}).")
+    return 1
+  total = totals.pop() if totals else 0
+  missing = [i for i in range(total) if i not in blocks]
+  if missing:
+    print(f"[ERR]: {len(missing)}/{total} MACROs are missing. check that all shards have finished.")
+    return 1
+
+  with open(out_lef, "w", encoding="utf-8") as f:
+    with open(head_file, "r", encoding="utf-8") as fh:
+      f.write(fh.read())
+    for i in range(total):
+      f.write(blocks[i])
+
+  print(f"[INF]: merged {len(frag_files)} fragments ({total} MACROs) into {out_lef}")
+  return 0
+
+
+def default_oas_cache_dir() -> str:
+  """
+  pya_gds2lef(-rd oas_cache=1)のOASIS cacheの保存先
+  """
+  base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+  return os.path.join(base, "pya_tools", "oas")
+
+
+def parse_size(size: str) -> int:
+  """
+  サイズ指定(ex: 500M, 2G)をbyte数に変換
+  """
+  m = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*", str(size).upper())
+  if not m:
+    raise ValueError(f"illegal size format. ({size})")
+  return int(float(m.group(1)) * 1024 ** " KMGT".index(m.group(2) or " "))
+
+
+def clean_oas_cache(cache_dir: str, max_size: int = 0) -> int:
+  """
+  OASIS cacheから、元のGDSが無い/変更されたもの、途中で残った一時ファイルを削除。
+  max_size指定時は、合計サイズがmax_size以下になるまで最後に使われた時刻が古いものから削除。
+  """
+  if not os.path.isdir(cache_dir):
+    print(f"[INF]: no OASIS cache in {cache_dir}")
+    return 0
+
+  removed = 0
+  entries = []
+  for name in sorted(os.listdir(cache_dir)):
+    path = os.path.join(cache_dir, name)
+    if name.endswith(".tmp.oas"):
+      os.remove(path)
+      continue
+    if not name.endswith(".json"):
+      if name.endswith(".oas") and not os.path.exists(path[:-4] + ".json"):
+        os.remove(path)
+      continue
+
+    base = path[:-5]
+    try:
+      with open(path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+      st = os.stat(meta["source"])
+      stale = st.st_size != meta["size"] or not os.path.isfile(base + ".oas")
+    except (OSError, ValueError, KeyError):
+      stale = True
+
+    if stale:
+      for ext in (".json", ".oas"):
+        if os.path.exists(base + ext):
+          os.remove(base + ext)
+      removed += 1
+    else:
+      entries.append((meta.get("last_used", 0), meta.get("oas_size", 0), base))
+
+  total = sum(e[1] for e in entries)
+  if max_size:
+    for last_used, oas_size, base in sorted(entries):
+      if total <= max_size:
+        break
+      for ext in (".json", ".oas"):
+        if os.path.exists(base + ext):
+          os.remove(base + ext)
+      total -= oas_size
+      removed += 1
+
+  print(f"[INF]: removed {removed} OASIS cache entries, {total/(1024*1024):.1f}MB left in {cache_dir}")
+  return 0
+
+
 def main():
   available = list_available_scripts()  
   parser = argparse.ArgumentParser(description="Run a pip-installed klayout pya script")
@@ -61,10 +184,33 @@ def main():
     "--pya",
     dest="pya",
     type=str,
-    required=True,
+    required=False,
     help=f"Script name inside scripts (available: {', '.join(available)})"
   )
 
+  parser.add_argument("--merge-lef",
+    dest="merge_lef",
+    type=str,
+    metavar="OUT_LEF",
+    help="Merge fragments of pya_gds2lef(-rd shard=i/N) into OUT_LEF"
+                       )
+
+  parser.add_argument("--clean-oas-cache",
+    dest="clean_oas_cache",
+    nargs="?",
+    const=default_oas_cache_dir(),
+    metavar="DIR",
+    help="Remove stale entries of the OASIS cache of pya_gds2lef(-rd oas_cache=...)"
+                       )
+
+  parser.add_argument("--oas-cache-size",
+    dest="oas_cache_size",
+    type=parse_size,
+    default=0,
+    metavar="SIZE",
+    help="With --clean-oas-cache, also remove least recently used entries until the cache is under SIZE (ex: 20G)"
+                       )
+
   parser.add_argument("--copy-config",
     action="store_true",
     help="Copy config for the given --pya"
@@ -74,6 +220,17 @@ def main():
   # 残りの全ての引数（KLayoutにそのまま渡す）
   args, unknown_args = parser.parse_known_args()
 
+  # merge shards of pya_gds2lef
+  if args.merge_lef:
+    sys.exit(merge_lef_shards(args.merge_lef))
+
+  # clean OASIS cache of pya_gds2lef
+  if args.clean_oas_cache:
+    sys.exit(clean_oas_cache(args.clean_oas_cache, args.oas_cache_size))
+
+  if not args.pya:
+    parser.error("the following arguments are required: --pya")
+
   # pyaスクリプト名を取得
   script_name = args.pya + ".py"
 
@@ -3,57 +3,1100 @@
 #===================================================================
 # This file is associated with the pya_toos project.
 # Copyright (C) 2025 LogicResearch K.K (Author: MATSUDA Masahiro)
-# 
+#
 # This script file is licensed under the MIT License.
 #===================================================================
 import pya
-import os, sys
+import os, sys, time
+import fnmatch, gzip, hashlib, heapq, itertools, json, re, shlex, shutil, struct, subprocess, tempfile
 
+try:
+    import resource  # for max RSS (not available on Windows)
+except ImportError:
+    resource = None
+
+# ------------------------
+# functions
+# ------------------------
+def max_rss_mb() -> float:
+    """
+    プロセスの最大RSS(MB)を返す。取得できない場合は0
+    """
+    if resource is None:
+        return 0.0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux:KB, macOS:byte
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+def report_usage(step: str, t_start: float):
+    """
+    処理時間と最大RSSを表示
+    """
+    print(f"[INFO] {step}: {time.perf_counter() - t_start:.2f}s, max_rss={max_rss_mb():.1f}MB")
+
+def count_devices(circuit: pya.Circuit) -> int:
+    """
+    circuit直下のdevice数を返す
+    """
+    return sum(1 for _ in circuit.each_device())
+
+def find_top_circuit(netlist: pya.Netlist, top_name: str) -> pya.Circuit:
+    """
+    top_nameの回路を返す。存在しなければ終了
+    """
+    circuit = netlist.circuit_by_name(top_name)
+    if circuit is None:
+        print(f"[ERROR]: top cell '{top_name}' does not exist.", file=sys.stderr)
+        sys.exit(1)
+    return circuit
+
+def to_bool(value) -> bool:
+    """
+    -rdで与えられた文字列をboolへ変換
+    """
+    return str(value).strip().lower() not in ("0", "false", "no", "off", "")
+
+def reachable_circuits(roots: list) -> set:
+    """
+    roots(回路のリスト)から参照される回路名の集合を返す(roots自身を含む)
+    """
+    used = set(c.name for c in roots)
+    stack = list(roots)
+    while stack:
+        for child in stack.pop().each_child():
+            if child.name not in used:
+                used.add(child.name)
+                stack.append(child)
+    return used
+
+def prune_unreachable(netlist: pya.Netlist, roots: list) -> tuple:
+    """
+    rootsから参照されない回路を削除し、(削除した回路数, device数)を返す
+    """
+    used = reachable_circuits(roots)
+
+    n_circuits = 0
+    n_devices  = 0
+    #-- remove parents first, so that no circuit is removed while still referenced
+    for circuit in list(netlist.each_circuit_top_down()):
+        if circuit.name not in used:
+            n_circuits += 1
+            n_devices  += count_devices(circuit)
+            netlist.remove(circuit)
+
+    return n_circuits, n_devices
+
+def flatten_hierarchy(netlist: pya.Netlist, roots: list, keep: list=[], depth: int=0):
+    """
+    roots以外の回路をまとめてflatten(各subcircuitは1回だけ展開)
+      keep : このglobパターンにmatchする回路と、その下の回路はflattenしない
+      depth: >0の場合、rootsのsubcircuit(instance)をdepth段まで展開(instance毎の深さ)
+    """
+    def is_kept(name: str) -> bool:
+        return any(fnmatch.fnmatchcase(name.upper(), k.upper()) for k in keep)
+
+    root_names = set(c.name for c in roots)
+    if depth > 0:
+        flatten_levels(netlist, roots, is_kept, depth)
+        return
+
+    #-- circuits under kept circuits are not flattened as a whole (flatten_circuits expands into every parent)
+    below_kept = reachable_circuits([c for c in netlist.each_circuit() if c.name not in root_names and is_kept(c.name)])
+    circuits = [c for c in netlist.each_circuit_bottom_up() if c.name not in root_names and c.name not in below_kept]
+
+    print(f"[INFO] flatten {len(circuits)} circuits into {', '.join(sorted(root_names))}")
+    if circuits:
+        netlist.flatten_circuits(circuits)
+
+    #-- instances of circuits also used under kept circuits are flattened one by one
+    n_flattened = flatten_instances(roots, is_kept)
+    if n_flattened:
+        print(f"[INFO] flatten {n_flattened} subcircuit instances of circuits also used under kept circuits")
+
+    kept = sorted(reachable_circuits(roots) - root_names)
+    if kept:
+        print(f"[INFO] keep {len(kept)} circuits (keep and circuits under them): {', '.join(kept)}")
+
+def flatten_instances(roots: list, is_kept, depth: int=0) -> int:
+    """
+    rootsのsubcircuit(instance)を1段ずつdepth段まで展開し、展開したinstance数を返す
+    (depth=0: 展開できるinstanceがなくなるまで)
+    """
+    n_flattened = 0
+    level = 0
+    while depth <= 0 or level < depth:
+        subcircuits = [(root, sc) for root in roots for sc in root.each_subcircuit() if not is_kept(sc.circuit_ref().name)]
+        if not subcircuits:
+            break
+        for root, sc in subcircuits:
+            root.flatten_subcircuit(sc)
+        n_flattened += len(subcircuits)
+        level += 1
+    return n_flattened
+
+def flatten_levels(netlist: pya.Netlist, roots: list, is_kept, depth: int):
+    """
+    rootsのsubcircuitを1段ずつdepth段まで展開(同じ回路でも浅いinstanceは展開され、深いinstanceは残る)
+    展開後に参照されなくなった回路は削除
+    """
+    n_flattened = flatten_instances(roots, is_kept, depth)
+    print(f"[INFO] flatten {n_flattened} subcircuit instances up to depth {depth} into {', '.join(sorted(c.name for c in roots))}")
+
+    prune_unreachable(netlist, roots)
+    kept = sorted(reachable_circuits(roots) - set(c.name for c in roots))
+    if kept:
+        print(f"[INFO] keep {len(kept)} circuits (deeper than depth {depth} or keep): {', '.join(kept)}")
+
+def reduce_netlist(netlist: pya.Netlist, roots: list) -> tuple:
+    """
+    並列/直列deviceを結合し、floating netを削除
+    戻り値: (結合前のdevice数, 結合後のdevice数)
+    """
+    n_before = sum(count_devices(c) for c in roots)
+    netlist.combine_devices()
+    netlist.purge_nets()
+    n_after  = sum(count_devices(c) for c in roots)
+    return n_before, n_after
+
+def parse_list(value) -> list:
+    """
+    -rdで与えられたカンマ区切りの文字列をリストへ変換
+    """
+    return [v.strip() for v in str(value).split(",") if v.strip()]
+
+def strip_parameters(netlist: pya.Netlist, drop_params: list) -> dict:
+    """
+    device classからdrop_paramsのパラメータ定義を削除
+    戻り値: {device class名: 残したパラメータの元id}
+    備考) deviceの値は元idのまま残るため、書き込み時にSpiceWriterDelegateで詰め直す
+    """
+    drop = set(p.upper() for p in drop_params)
+    param_map = {}
+    for device_class in netlist.each_device_class():
+        defs = list(device_class.parameter_definitions())
+        if not any(d.name.upper() in drop for d in defs):
+            continue
+
+        kept = [(d.id(), pya.DeviceParameterDefinition(d.name, d.description, d.default_value, d.is_primary, d.si_scaling, d.geo_scaling_exponent))
+                for d in defs if d.name.upper() not in drop]
+        device_class.clear_parameters()
+        for _, d in kept:
+            device_class.add_parameter(d)
+        param_map[device_class.name] = [i for i, _ in kept]
+
+        print(f"[INFO] drop parameters of {device_class.name}: {','.join(d.name for d in defs if d.name.upper() in drop)}")
+
+    return param_map
+
+class SpiceWriterDelegate(pya.NetlistSpiceWriterDelegate):
+    """
+    書き込み時に、deviceのパラメータ値の詰め直し(strip_parameters)と有効桁数の丸めを行う
+    """
+    def __init__(self, param_map: dict, digits: int=0):
+        super().__init__()
+        self.param_map = param_map
+        self.digits    = digits
+
+    def write_device(self, device: pya.Device):
+        device_class = device.device_class()
+        ids = self.param_map.get(device_class.name)
+        if ids is None and self.digits > 0:
+            ids = [d.id() for d in device_class.parameter_definitions()]
+
+        if ids:
+            values = [device.parameter(i) for i in ids]
+            if self.digits > 0:
+                values = [float(f"{v:.{self.digits}g}") for v in values]
+            for new_id, v in enumerate(values):
+                device.set_parameter(new_id, v)
+
+        super().write_device(device)
+
+def parse_size(value) -> int:
+    """
+    サイズ指定("500M","2G","100k",数値)をbyte数へ変換
+    """
+    text = str(value).strip().upper().rstrip("B")
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(float(text))
+
+def split_ext(path: str) -> tuple:
+    """
+    pathを(stem, 拡張子)に分割。圧縮拡張子は含めて返す
+      ex) chip.sp.gz ---> ("chip", ".sp.gz")
+    """
+    stem, ext = os.path.splitext(path)
+    if ext in (".gz", ".zst"):
+        stem, ext2 = os.path.splitext(stem)
+        ext = ext2 + ext
+    return stem, ext
+
+class ZstdWriter:
+    """
+    zstdコマンドへ書き込むfile object
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.proc = subprocess.Popen(["zstd", "-q", "-f", "-T0", "-o", path], stdin=subprocess.PIPE)
+
+    def write(self, data: bytes):
+        self.proc.stdin.write(data)
+
+    def close(self):
+        self.proc.stdin.close()
+        if self.proc.wait() != 0:
+            raise RuntimeError(f"zstd failed for {self.path}")
+
+def check_zstd():
+    """
+    zstdコマンドの有無を確認
+    """
+    if shutil.which("zstd") is None:
+        print(f"[ERROR]: zstd command is required to write '.zst' files.", file=sys.stderr)
+        sys.exit(1)
+
+def open_output(path: str):
+    """
+    拡張子(.gz/.zst)にあわせて、書き込み用のbinary file objectを返す
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, "wb", compresslevel=6)
+    if path.endswith(".zst"):
+        return ZstdWriter(path)
+    return open(path, "wb")
+
+INDEX_MAGIC        = b"PYANIDX2"
+INDEX_HEADER       = struct.Struct("<8sIIQQQQ")  # magic, n_files, n_keys, files/keys/names/postings offset
+INDEX_ENTRY        = struct.Struct("<II")        # name offset, postings offset (n_keys+1 entries, the last one is the end)
+INDEX_OFFSET_BITS  = 40                          # posting = file_no << 40 | byte offset
+INDEX_RUN_SIZE     = 1 << 18                     # number of (key, posting) sorted in memory per temp file
+
+def encode_postings(postings) -> bytes:
+    """
+    昇順のpostingを差分のvarint(LEB128)へ変換(重複は除く)
+    """
+    data = bytearray()
+    prev = 0
+    for p in postings:
+        if data and p == prev:
+            continue
+        d, prev = p - prev, p
+        while d >= 0x80:
+            data.append((d & 0x7f) | 0x80)
+            d >>= 7
+        data.append(d)
+    return bytes(data)
+
+class NetIndexBuilder:
+    """
+    SPICEの出力行から、device名/net名 -> byte offsetのindexを作成
+    (indexの形式と検索はpya_netindex.pyを参照)
+    (key, posting)はINDEX_RUN_SIZE毎にsortしてtmp_dirの一時ファイルへ書き出し、write()でmergeする
+    """
+    def __init__(self, tmp_dir: str=None):
+        self.tmp_dir = tmp_dir
+        self.run     = []    # b"<key>\t<posting(hex 16桁)>" (sortでkey順、同じkeyはposting順になる)
+        self.runs    = []    # sort済の一時ファイル
+        self.pending = None
+
+    def add_line(self, file_no: int, offset: int, line: bytes):
+        """
+        出力した1行を追加(継続行は前の行とまとめて処理)
+        """
+        if line.startswith(b"+"):
+            if self.pending is not None:
+                self.pending[2].append(line)
+            return
+
+        self.flush()
+        if line[:1] not in (b"*", b"\n", b"\r", b""):
+            self.pending = (file_no, offset, [line])
+
+    def flush(self):
+        if self.pending is None:
+            return
+        file_no, offset, lines = self.pending
+        self.pending = None
+
+        tokens = b" ".join(l.lstrip(b"+") for l in lines).split()
+        posting = (file_no << INDEX_OFFSET_BITS) | offset
+        head = tokens[0].upper()
+        if head.startswith(b"."):
+            if head == b".SUBCKT":
+                for net in tokens[2:]:
+                    self.add_key(b"N:" + net, posting)
+            return
+
+        self.add_key(b"D:" + tokens[0], posting)
+        if head[:1] in (b"R", b"C", b"L"):
+            nets = tokens[1:3]
+        else:
+            nets = [t for t in tokens[1:] if b"=" not in t][:-1]
+        for net in nets:
+            self.add_key(b"N:" + net, posting)
+
+    def add_key(self, key: bytes, posting: int):
+        self.run.append(b"%s\t%016x" % (key, posting))
+        if len(self.run) >= INDEX_RUN_SIZE:
+            self.spill()
+
+    def spill(self):
+        """
+        メモリ上の(key, posting)をsortして一時ファイルへ書き出す
+        """
+        if not self.run:
+            return
+        self.run.sort()
+        f = tempfile.TemporaryFile(dir=self.tmp_dir)
+        f.write(b"\n".join(self.run))
+        f.write(b"\n")
+        f.seek(0)
+        self.runs.append(f)
+        self.run = []
+
+    def write(self, path: str, files: list):
+        """
+        indexファイルを書き込む(一時ファイルをk-way mergeし、keyはsort済、mmapして二分探索できる形式)
+        """
+        self.flush()
+        self.spill()
+        files_data = json.dumps([os.path.basename(f) for f in files]).encode()
+
+        n_keys = names_size = postings_size = 0
+        with tempfile.TemporaryFile(dir=self.tmp_dir) as entries, \
+             tempfile.TemporaryFile(dir=self.tmp_dir) as names, \
+             tempfile.TemporaryFile(dir=self.tmp_dir) as postings:
+            #-- line: key + b"\t" + posting(16) + b"\n"
+            for key, lines in itertools.groupby(heapq.merge(*self.runs), key=lambda l: l[:-18]):
+                data = encode_postings(int(l[-17:-1], 16) for l in lines)
+                entries.write(INDEX_ENTRY.pack(names_size, postings_size))
+                names.write(key)
+                postings.write(data)
+                names_size    += len(key)
+                postings_size += len(data)
+                n_keys += 1
+                if names_size >= 1 << 32 or postings_size >= 1 << 32:
+                    raise ValueError(f"index is too large for 32bit offsets ({path}).")
+            entries.write(INDEX_ENTRY.pack(names_size, postings_size))
+            for f in self.runs:
+                f.close()
+            self.runs = []
+
+            files_off    = INDEX_HEADER.size
+            keys_off     = files_off + len(files_data)
+            names_off    = keys_off + (n_keys + 1) * INDEX_ENTRY.size
+            postings_off = names_off + names_size
+
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(INDEX_HEADER.pack(INDEX_MAGIC, len(files), n_keys, files_off, keys_off, names_off, postings_off))
+                f.write(files_data)
+                for section in (entries, names, postings):
+                    section.seek(0)
+                    shutil.copyfileobj(section, f, 1024 * 1024)
+            os.replace(tmp, path)
+
+def write_stream(fin, ofile: str, split_size: int=0, index_path: str=None) -> list:
+    """
+    finから読んだSPICEをofileへ書き込み、書き込んだファイルのリストを返す
+      split_size>0 : split_size毎のpartファイルへ分割(継続行("+")の途中では分割しない)
+      index_path   : device名/net名のindexを作成
+    """
+    stem, ext = split_ext(ofile)
+    index = NetIndexBuilder(os.path.dirname(os.path.abspath(index_path))) if index_path else None
+    paths = []
+    fout = None
+    size = 0
+    for line in fin:
+        if fout is None or (split_size > 0 and size >= split_size and not line.startswith(b"+")):
+            if fout is not None:
+                fout.close()
+            paths.append(f"{stem}.part{len(paths)+1:04d}{ext}" if split_size > 0 else ofile)
+            fout = open_output(paths[-1])
+            size = 0
+        if index is not None:
+            index.add_line(len(paths) - 1, size, line)
+        fout.write(line)
+        size += len(line)
+    if fout is not None:
+        fout.close()
+
+    if index is not None:
+        index.write(index_path, paths)
+    return paths
+
+def write_master(ofile: str, part_paths: list):
+    """
+    partファイルを.INCLUDEするmasterファイルを書き込む
+    """
+    fout = open_output(ofile)
+    fout.write(f"* This file is generated by pya_flatspice ({len(part_paths)} parts).\n".encode())
+    for path in part_paths:
+        fout.write(f'.INCLUDE "{os.path.basename(path)}"\n'.encode())
+    fout.close()
+
+def write_stream_child(netlist: pya.Netlist, writer: pya.NetlistSpiceWriter, ofile: str, split_size: int=0, index_path: str=None):
+    """
+    KLayoutの出力をpipeで子プロセスへ流し、中間ファイルを作らずにpartファイルへの分割やindex作成を行う
+    """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        #-- child: read from pipe and write files
+        os.close(w)
+        status = 0
+        try:
+            with os.fdopen(r, "rb", buffering=1024*1024) as fin:
+                paths = write_stream(fin, ofile, split_size, index_path)
+            if split_size > 0:
+                write_master(ofile, paths)
+                print(f"[INFO] wrote {len(paths)} parts for {ofile}")
+            if index_path:
+                print(f"[INFO] wrote index {index_path}")
+        except Exception as e:
+            print(f"[ERROR]: write failed: {e}", file=sys.stderr)
+            status = 1
+        sys.stdout.flush()
+        os._exit(status)
+
+    #-- parent: write netlist to the pipe
+    os.close(r)
+    os.set_inheritable(w, True)
+    try:
+        netlist.write(f"pipe:cat >&{w}", writer)
+    finally:
+        os.close(w)
+        _, status = os.waitpid(pid, 0)
+    if status != 0:
+        print(f"[ERROR]: failed to write '{ofile}'.", file=sys.stderr)
+        sys.exit(1)
+
+def write_netlist(netlist: pya.Netlist, writer: pya.NetlistSpiceWriter, ofile: str, split_size: int=0, index: bool=False):
+    """
+    netlistを書き込む
+      .gz : KLayoutで圧縮して書き込み
+      .zst: zstdコマンドへpipeで書き込み
+      split_size>0: partファイルとmasterファイルへ分割
+      index=True  : ofile+".idx"へdevice名/net名のindexを作成
+    """
+    if ofile.endswith(".zst"):
+        check_zstd()
+
+    if split_size > 0 or index:
+        write_stream_child(netlist, writer, ofile, split_size, f"{ofile}.idx" if index else None)
+    elif ofile.endswith(".zst"):
+        netlist.write(f"pipe:zstd -q -f -T0 -o {shlex.quote(ofile)}", writer)
+    else:
+        netlist.write(ofile, writer)
+
+INCLUDE_PATTERN = re.compile(rb"""^[ \t]*\.(?:include|inc|lib)[ \t]+(?:"([^"\r\n]+)"|'([^'\r\n]+)'|([^\s]+))""", re.IGNORECASE | re.MULTILINE)
+
+GLOBAL_PATTERN  = re.compile(rb"^[ \t]*\.global\b", re.IGNORECASE | re.MULTILINE)
+
+CACHE_VERSION = 1
+
+def scan_spice(path: str, h=None) -> list:
+    """
+    SPICEファイルを読み、.include/.libで参照されるファイル(存在するもの)を返す
+    hを与えた場合は、ファイル内容でhashを更新
+    """
+    includes = []
+    base_dir = os.path.dirname(path)
+    rest = b""
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(8*1024*1024)
+            if not chunk:
+                break
+            if h is not None:
+                h.update(chunk)
+
+            #-- search only complete lines
+            data = rest + chunk
+            pos  = data.rfind(b"\n") + 1
+            rest = data[pos:]
+            for m in INCLUDE_PATTERN.finditer(data, 0, pos):
+                includes.append(m.group(1) or m.group(2) or m.group(3))
+
+        for m in INCLUDE_PATTERN.finditer(rest):
+            includes.append(m.group(1) or m.group(2) or m.group(3))
+
+    paths = []
+    for inc in includes:
+        inc_path = os.path.join(base_dir, os.fsdecode(inc))
+        if os.path.isfile(inc_path):
+            paths.append(os.path.normpath(inc_path))
+    return paths
+
+def deck_files(ifile: str, h=None) -> list:
+    """
+    ifileと、.includeで参照される全ファイルを返す(ifileから順に、重複なし)
+    hを与えた場合は、全ファイルの内容でhashを更新
+    """
+    files = []
+    seen  = set()
+    stack = [os.path.normpath(ifile)]
+    while stack:
+        path = stack.pop()
+        if path in seen:
+            continue
+        seen.add(path)
+        files.append(path)
+        if h is not None:
+            h.update(path.encode() + b"\0")
+        stack.extend(reversed(scan_spice(path, h)))
+    return files
+
+def has_globals(files: list) -> bool:
+    """
+    いずれかのファイルに.GLOBAL文があるか
+    (global netは使用するsubcktと全ての呼び出し元のpinになるため、ファイル毎に読み込むと接続が失われる)
+    """
+    for path in files:
+        rest = b""
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(8*1024*1024)
+                if not chunk:
+                    break
+                data = rest + chunk
+                pos  = data.rfind(b"\n") + 1
+                rest = data[pos:]
+                if GLOBAL_PATTERN.search(data, 0, pos):
+                    return True
+        if GLOBAL_PATTERN.search(rest):
+            return True
+    return False
+
+def klayout_version() -> str:
+    """
+    KLayoutのversionを返す
+    """
+    if hasattr(pya, "Application"):
+        return pya.Application.instance().version()
+    return getattr(pya, "__version__", "")
+
+def deck_key(ifile: str) -> str:
+    """
+    ifileと.includeファイルの内容から、cacheのkeyを返す
+    """
+    h = hashlib.sha256()
+    h.update(f"{CACHE_VERSION}:{klayout_version()}\0".encode())
+    deck_files(ifile, h)
+    return h.hexdigest()
+
+def netlist_header(netlist: pya.Netlist) -> dict:
+    """
+    Netlist.to_s()で保存されない情報(device class定義など)を返す
+    """
+    device_classes = []
+    for dc in netlist.each_device_class():
+        device_classes.append({
+            "name"      : dc.name,
+            "type"      : type(dc).__name__,
+            "terminals" : [[t.name, t.description] for t in dc.terminal_definitions()],
+            "parameters": [[p.name, p.description, p.default_value, p.is_primary, p.si_scaling, p.geo_scaling_exponent] for p in dc.parameter_definitions()],
+        })
+    return {"case_sensitive": netlist.is_case_sensitive(), "device_classes": device_classes}
+
+def create_netlist(header: dict) -> pya.Netlist:
+    """
+    netlist_header()の情報から、空のnetlistを作成
+    """
+    netlist = pya.Netlist()
+    netlist.case_sensitive = header["case_sensitive"]
+    for dc in header["device_classes"]:
+        device_class = getattr(pya, dc["type"])()
+        device_class.name = dc["name"]
+
+        #-- restore definitions if different from the built-in class
+        if [t.name for t in device_class.terminal_definitions()] != [t[0] for t in dc["terminals"]]:
+            device_class.clear_terminals()
+            for t in dc["terminals"]:
+                device_class.add_terminal(pya.DeviceTerminalDefinition(*t))
+        if [p.name for p in device_class.parameter_definitions()] != [p[0] for p in dc["parameters"]]:
+            device_class.clear_parameters()
+            for p in dc["parameters"]:
+                device_class.add_parameter(pya.DeviceParameterDefinition(*p))
+
+        netlist.add(device_class)
+    return netlist
+
+def save_netlist_cache(netlist: pya.Netlist, path: str, key: str):
+    """
+    netlistをcacheファイルへ保存(KLayoutのnetlist文字列表現 + device class定義)
+    """
+    header = netlist_header(netlist)
+    header.update({"version": CACHE_VERSION, "key": key})
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with gzip.open(tmp, "wt", encoding="utf-8", compresslevel=1) as f:
+            f.write(json.dumps(header) + "\n")
+            f.write(netlist.to_s())
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"[WARNING]: cannot write cache '{path}': {e}")
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def load_netlist_cache(path: str, key: str):
+    """
+    cacheファイルからnetlistを読み込む。keyが一致しない場合はNone
+    """
+    if not os.path.isfile(path):
+        return None
+
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        header = json.loads(f.readline())
+        if header.get("version") != CACHE_VERSION or header.get("key") != key:
+            return None
+
+        netlist = create_netlist(header)
+        netlist.from_s(f.read())
+    return netlist
+
+NAME_PATTERN       = r"(?:'(?:[^'\\]|\\.)*'|[^\s,=();']+)"
+CIRCUIT_PATTERN    = re.compile(rf"circuit ({NAME_PATTERN}) \((.*)\);")
+PIN_PATTERN        = re.compile(rf"({NAME_PATTERN})=")
+PLACEHOLDER_PIN    = re.compile(r"'\d+'")
+
+def parse_spice_part(ifile: str, opath: str):
+    """
+    (子プロセス用) ifileを.includeを無視して読み込み、opathへ保存
+    """
+    path = ifile
+    with open(ifile, "rb") as f:
+        data = f.read()
+    if INCLUDE_PATTERN.search(data):
+        #-- comment out .include (included files are read by other jobs)
+        path = f"{opath}.sp"
+        with open(path, "wb") as f:
+            f.write(INCLUDE_PATTERN.sub(lambda m: b"* " + m.group(0), data))
+
+    netlist = pya.Netlist()
+    netlist.read(path, pya.NetlistSpiceReader())
+    with open(opath, "w", encoding="utf-8") as f:
+        f.write(json.dumps(netlist_header(netlist)) + "\n")
+        f.write(netlist.to_s())
+
+def split_circuits(text: str) -> list:
+    """
+    Netlist.to_s()の文字列を、(回路名, pin名のリスト, block文字列)のリストに分割
+    """
+    circuits = []
+    for block in text.split("\nend;\n"):
+        block = block.strip("\n")
+        if not block:
+            continue
+        block += "\nend;\n"
+        m = CIRCUIT_PATTERN.match(block)
+        pins = PIN_PATTERN.findall(m.group(2))
+        circuits.append((m.group(1), pins, block))
+    return circuits
+
+def is_placeholder(pins: list, block: str) -> bool:
+    """
+    ファイル単体の読み込みで、未定義のsubcktに対して作成された空の回路か
+    """
+    return block.count("\n") == 2 and all(PLACEHOLDER_PIN.fullmatch(p) for p in pins)
+
+def rename_placeholder_pins(block: str, names: dict) -> str:
+    """
+    block中のsubcircuit行で、placeholder回路のpin参照('1','2'..)を定義側のpin名へ置換
+      names: {回路名: pin名のリスト}
+    """
+    lines = block.split("\n")
+    for i, line in enumerate(lines):
+        m = re.match(rf"(\s*subcircuit ({NAME_PATTERN}) .*?\()(.*)(\);)$", line)
+        if not m or m.group(2) not in names:
+            continue
+        pins = names[m.group(2)]
+        args = re.sub(r"(^|,)'(\d+)'=", lambda a: f"{a.group(1)}{pins[int(a.group(2))-1]}=", m.group(3))
+        lines[i] = m.group(1) + args + m.group(4)
+    return "\n".join(lines)
+
+def merge_spice_parts(files: list, parts: list) -> pya.Netlist:
+    """
+    ファイル毎に読み込んだnetlist(parse_spice_partの出力)を1つのnetlistへまとめる
+    subcktの重複定義は、内容が同じ場合は警告、異なる場合はエラー
+    """
+    headers     = []
+    part_blocks = []
+    for part in parts:
+        with open(part, "r", encoding="utf-8") as f:
+            headers.append(json.loads(f.readline()))
+            part_blocks.append(split_circuits(f.read()))
+
+    #-- device classes
+    header = {"case_sensitive": headers[0]["case_sensitive"], "device_classes": []}
+    class_types = {}
+    errors = []
+    for path, h in zip(files, headers):
+        for dc in h["device_classes"]:
+            if dc["name"] not in class_types:
+                class_types[dc["name"]] = (dc["type"], path)
+                header["device_classes"].append(dc)
+            elif class_types[dc["name"]][0] != dc["type"]:
+                errors.append(f"device class {dc['name']}: {dc['type']} in {path}, {class_types[dc['name']][0]} in {class_types[dc['name']][1]}")
+
+    #-- circuit definitions
+    defined = {}   # name -> (path, pins, block)
+    for path, blocks in zip(files, part_blocks):
+        for name, pins, block in blocks:
+            if is_placeholder(pins, block):
+                continue
+            if name not in defined:
+                defined[name] = (path, pins, block)
+            elif defined[name][2] != block:
+                errors.append(f"subckt {name}: defined differently in {defined[name][0]} and {path}")
+            else:
+                print(f"[WARNING]: subckt {name} is defined in {defined[name][0]} and {path} (same contents).")
+
+    #-- placeholders
+    placeholders = {}   # name -> pins
+    renames = []        # per file, {name: pins of definition}
+    for path, blocks in zip(files, part_blocks):
+        names = {}
+        for name, pins, block in blocks:
+            if not is_placeholder(pins, block):
+                continue
+            if name not in defined:
+                placeholders.setdefault(name, block)
+            elif len(pins) != len(defined[name][1]):
+                errors.append(f"subckt {name}: {len(defined[name][1])} pins in {defined[name][0]}, called with {len(pins)} pins in {path}")
+            else:
+                names[name] = defined[name][1]
+        renames.append(names)
+
+    if errors:
+        for e in errors:
+            print(f"[ERROR]: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    #-- merge
+    texts = []
+    for path, blocks, names in zip(files, part_blocks, renames):
+        for name, pins, block in blocks:
+            if defined.get(name, (None,))[0] == path and defined[name][2] is block:
+                texts.append(rename_placeholder_pins(block, names) if names else block)
+    texts.extend(placeholders.values())
+
+    netlist = create_netlist(header)
+    netlist.from_s("".join(texts))
+    return netlist
+
+def read_spice_parallel(ifile: str, files: list, n_jobs: int) -> pya.Netlist:
+    """
+    ifileと.includeファイルを子プロセスで並列に読み込み、1つのnetlistへまとめる
+    """
+    tmp_dir = tempfile.mkdtemp(prefix="pya_flatspice_")
+    try:
+        parts = [os.path.join(tmp_dir, f"part{i:05d}.txt") for i in range(len(files))]
+        batch = BatchJobs(n_jobs, verbose=False)
+        for path, part in zip(files, parts):
+            batch.submit(path, parse_spice_part, path, part)
+        if batch.wait() > 0:
+            print(f"[ERROR]: failed to read {ifile}. (parallel_read=0 reads the deck sequentially)", file=sys.stderr)
+            sys.exit(1)
+
+        return merge_spice_parts(files, parts)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def read_netlist(ifile: str, cache: bool=False, parallel_jobs: int=0) -> pya.Netlist:
+    """
+    ifileを読み込む
+    cache=Trueの場合、ifile+".pyacache"が有効なら読み込み、無効なら作成する
+    parallel_jobs>0の場合、.includeファイルを並列に読み込む
+    """
+    t_start = time.perf_counter()
+    if cache:
+        path = f"{ifile}.pyacache"
+        key  = deck_key(ifile)
+        netlist = load_netlist_cache(path, key)
+        if netlist is not None:
+            report_usage(f"read {ifile} (cache)", t_start)
+            return netlist
+
+    files = deck_files(ifile) if parallel_jobs > 0 else [ifile]
+    if len(files) > 1 and has_globals(files):
+        print(f"[WARNING]: {ifile} uses .GLOBAL, reading sequentially (parallel_read is not applicable).")
+        files = [ifile]
+    if len(files) > 1:
+        netlist = read_spice_parallel(ifile, files, parallel_jobs)
+        report_usage(f"read {ifile} ({len(files)} files in parallel)", t_start)
+    else:
+        netlist = pya.Netlist()
+        netlist.read(ifile, pya.NetlistSpiceReader())
+        report_usage(f"read {ifile}", t_start)
+
+    if cache:
+        t_start = time.perf_counter()
+        save_netlist_cache(netlist, path, key)
+        report_usage(f"write cache {path}", t_start)
+
+    return netlist
+
+def flatten_top(netlist: pya.Netlist, top_name: str, ofile: str, options: dict):
+    """
+    netlistのtop_nameをflattenしてofileへ書き込む(netlistは変更される)
+    """
+    #-- search target cell
+    top_circuit = find_top_circuit(netlist, top_name)
+
+    #-- keep other top-level circuits if required
+    roots = [top_circuit]
+    if not options["prune_tops"]:
+        roots += [c for c in netlist.top_circuits() if c.name != top_circuit.name]
+
+    #-- remove cells not reachable from top-cell
+    t_start = time.perf_counter()
+    n_circuits, n_devices = prune_unreachable(netlist, roots)
+    print(f"[INFO] pruned {n_circuits} circuits ({n_devices} devices) not reachable from {top_circuit.name}")
+
+    #-- flatten cell except top-cell
+    flatten_hierarchy(netlist, roots, options["keep"], options["depth"])
+    report_usage(f"flatten {top_circuit.name} ({sum(count_devices(c) for c in roots)} devices)", t_start)
+
+    #-- combine devices
+    if options["reduce"]:
+        t_start = time.perf_counter()
+        n_before, n_after = reduce_netlist(netlist, roots)
+        report_usage(f"reduce ({n_before} -> {n_after} devices)", t_start)
+
+    #--- write out
+    param_map = strip_parameters(netlist, options["drop_params"]) if options["drop_params"] else {}
+    if param_map or options["digits"] > 0:
+        writer=pya.NetlistSpiceWriter(SpiceWriterDelegate(param_map, options["digits"]))
+    else:
+        writer=pya.NetlistSpiceWriter()
+    writer.use_net_names=True
+    writer.with_comments=options["comments"]
+
+    t_start = time.perf_counter()
+    write_netlist(netlist, writer, ofile, options["split_size"], options["index"])
+    report_usage(f"write {ofile}", t_start)
+
+def output_path(ofile: str, ifile: str, top_name: str) -> str:
+    """
+    ofile中の{ifile}/{top}を置換した出力ファイル名を返す
+    """
+    stem, _ = split_ext(os.path.basename(ifile))
+    return ofile.replace("{ifile}", stem).replace("{top}", top_name)
+
+class BatchJobs:
+    """
+    jobを子プロセス(fork)で並列実行する
+    子プロセスはfork時点のnetlistのコピーを持つため、親のnetlistは変更されない
+    """
+    def __init__(self, n_jobs: int, verbose: bool=True):
+        self.n_jobs  = max(1, n_jobs)
+        self.verbose = verbose
+        self.running = {}
+        self.failed  = []
+
+    def submit(self, name: str, func, *args):
+        while len(self.running) >= self.n_jobs:
+            self._wait_one()
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            #-- child
+            status = 0
+            try:
+                func(*args)
+            except SystemExit as e:
+                status = e.code if isinstance(e.code, int) else 1
+            except Exception as e:
+                print(f"[ERROR]: {name}: {e}", file=sys.stderr)
+                status = 1
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+        self.running[pid] = name
+        if self.verbose:
+            print(f"[INFO] start job {name} (pid={pid})")
+
+    def _wait_one(self):
+        """
+        このpoolの子プロセスのどれか1つの終了を待つ
+        (os.wait()は他のpool(parallel_readなど)の子プロセスも回収してしまうため、自分のpidのみ待つ)
+        """
+        while True:
+            for pid in list(self.running):
+                done, status = os.waitpid(pid, os.WNOHANG)
+                if done:
+                    break
+            else:
+                time.sleep(0.01)
+                continue
+            break
+
+        name = self.running.pop(pid)
+        if status != 0:
+            print(f"[ERROR]: job {name} failed (status={status}).", file=sys.stderr)
+            self.failed.append(name)
+        elif self.verbose:
+            print(f"[INFO] done job {name}")
+
+    def wait(self) -> int:
+        """
+        全jobの終了を待ち、失敗したjob数を返す
+        """
+        while self.running:
+            self._wait_one()
+        return len(self.failed)
+
+# ------------------------
+# klayout(main)
+# ------------------------
 # argument is given from klayout -rd <name>=<value> options.
 #  ex) klayout -b -r pya_flatspice.py -rd ifile=xxx -rd ofile=yyyy -rd top=top_cell
-#ifile="top.spice"
-#ofile="top_flat.spice"
-#top="top"
+#ifile="top.spice"        # comma separated list is allowed
+#ofile="top_flat.spice"   # {ifile}/{top} is replaced for multiple ifile/top
+#top="top"                # comma separated list is allowed
+#cache=0          # 1: use/create netlist cache (ifile.pyacache)
+#parallel_read=0  # 1: read .include files in parallel
+#jobs=0           # number of parallel jobs for multiple ifile/top (0: cpu count)
+#prune_tops=1     # 0: keep other top-level circuits (flattened as well)
+#split_size=0     # >0: split ofile into part files of this size (ex: 500M)
+#index=0          # 1: write device/net name index (ofile.idx, see pya_netindex)
+#comments=1       # 0: no comments in ofile
+#keep=""          # circuits not flattened (glob list, ex: SRAM*,PLL)
+#depth=0          # >0: flatten subcircuit instances up to this depth from top
+#reduce=0         # 1: combine parallel/series devices after flatten
+#drop_params=""   # parameters not written (ex: AS,AD,PS,PD)
+#digits=0         # >0: significant digits of parameter values
+
+ifiles = parse_list(ifile)
+tops   = parse_list(top)
+
+if 'jobs' not in globals():
+    jobs = 0
+n_jobs = int(jobs) if int(jobs) > 0 else (os.cpu_count() or 1)
+
+if 'cache' not in globals():
+    cache = 0
+cache = to_bool(cache)
+
+if 'parallel_read' not in globals():
+    parallel_read = 0
+parallel_read = to_bool(parallel_read)
+
+if 'prune_tops' not in globals():
+    prune_tops = 1
+prune_tops = to_bool(prune_tops)
+
+if 'split_size' not in globals():
+    split_size = 0
+split_size = parse_size(split_size)
 
-print(f"[INFO] ifile={ifile}, ofile={ofile}, top={top}")
+if 'index' not in globals():
+    index = 0
+index = to_bool(index)
+
+if 'comments' not in globals():
+    comments = 1
+comments = to_bool(comments)
+
+if 'keep' not in globals():
+    keep = ""
+keep = parse_list(keep)
+
+if 'depth' not in globals():
+    depth = 0
+depth = int(depth)
+
+if 'reduce' not in globals():
+    reduce = 0
+reduce = to_bool(reduce)
+
+if 'drop_params' not in globals():
+    drop_params = ""
+drop_params = parse_list(drop_params)
+
+if 'digits' not in globals():
+    digits = 0
+digits = int(digits)
+
+print(f"[INFO] ifile={ifile}, ofile={ofile}, top={top}, jobs={n_jobs}, cache={int(cache)}, parallel_read={int(parallel_read)}, prune_tops={int(prune_tops)}, reduce={int(reduce)}")
+print(f"[INFO] keep={','.join(keep)}, depth={depth}")
+print(f"[INFO] split_size={split_size}, index={int(index)}, comments={int(comments)}, drop_params={','.join(drop_params)}, digits={digits}")
+
+options = {
+    "prune_tops" : prune_tops,
+    "keep"       : keep,
+    "depth"      : depth,
+    "reduce"     : reduce,
+    "drop_params": drop_params,
+    "digits"     : digits,
+    "comments"   : comments,
+    "split_size" : split_size,
+    "index"      : index,
+}
 
 # check
-if not os.path.isfile(ifile):
-    print(f"[ERROR]: Input file '{ifile}' does not exist.", file=sys.stderr)
+for f in ifiles:
+    if not os.path.isfile(f):
+        print(f"[ERROR]: Input file '{f}' does not exist.", file=sys.stderr)
+        sys.exit(1)
+
+if len(tops) > 1 and "{top}" not in ofile:
+    print(f"[ERROR]: ofile must contain {{top}} for multiple top cells.", file=sys.stderr)
     sys.exit(1)
 
-# flatten
-netlist=pya.Netlist()
-reader=pya.NetlistSpiceReader()
-writer=pya.NetlistSpiceWriter()
-writer.use_net_names=True
+if index and (ofile.endswith(".gz") or ofile.endswith(".zst")):
+    print(f"[ERROR]: index=1 is not supported for compressed ofile.", file=sys.stderr)
+    sys.exit(1)
 
-netlist.read(ifile, reader)
+if len(ifiles) > 1 and "{ifile}" not in ofile:
+    print(f"[ERROR]: ofile must contain {{ifile}} for multiple input files.", file=sys.stderr)
+    sys.exit(1)
 
-top_name=top
+# read & flatten
+t_total = time.perf_counter()
+batch = BatchJobs(n_jobs) if (len(ifiles) > 1 or len(tops) > 1) else None
+done_tops = set()
+ofiles = set()
+for ifile in ifiles:
+    netlist = read_netlist(ifile, cache, n_jobs if parallel_read else 0)
 
-#-- search target cell
-if top_name in list(netlist.each_circuit()):
-    print(f"[ERROR]: top cell '{top_name}' does not exist.", file=sys.stderr)
-    sys.exit(1)
-    
-#-- flatten cell except top-cell
-for circuit in list(netlist.each_circuit()):
-    if circuit.name != top_name:
-        print(f"  [INFO] flatten cell{circuit.name}")
-        netlist.flatten_circuit(circuit.name)
-
-#---#-- remove AS/AD/PS/PD
-#---remove_params = {"AS", "AD", "PS", "PD"}
-#---for circuit in netlist.each_circuit():
-#---  for device in circuit.each_device():
-#---
-#---    #-- read parameter list (L,W,AS,AD,PS,PD)
-#---    for param_def in device.device_class().parameter_definitions():
-#---      print(param_def.name)
-#---      print(device.parameter("AD"))
-
-#--- write out
-netlist.write(ofile, writer)
+    for top in tops:
+        #-- top-cell is checked in flatten_top for single run
+        if batch is not None and netlist.circuit_by_name(top) is None:
+            print(f"[WARNING]: top cell '{top}' does not exist in {ifile}. skipped.")
+            continue
+
+        out = output_path(ofile, ifile, top)
+        if out in ofiles:
+            print(f"[ERROR]: output file '{out}' is written twice.", file=sys.stderr)
+            if batch is not None:
+                batch.wait()
+            sys.exit(1)
+        ofiles.add(out)
+        done_tops.add(top)
+
+        if batch is None:
+            flatten_top(netlist, top, out, options)
+        else:
+            batch.submit(f"{top} ({ifile})", flatten_top, netlist, top, out, options)
+
+    #-- children keep their own copy of the netlist
+    netlist._destroy()
+
+if batch is not None:
+    n_failed = batch.wait()
+    missing = [t for t in tops if t not in done_tops]
+    if missing:
+        print(f"[ERROR]: top cell '{','.join(missing)}' does not exist.", file=sys.stderr)
+    report_usage(f"total ({len(ofiles)} outputs)", t_total)
+    if n_failed > 0 or missing:
+        sys.exit(1)
 
 #EOF
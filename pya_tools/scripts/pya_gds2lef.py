@@ -13,8 +13,10 @@ import pya  # for KLayout
 
 import re
 import os,sys,argparse
+import struct, time, hashlib
+from array import array
 
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 from  typing import Any,Dict
 
 from datetime import datetime
@@ -519,116 +521,432 @@ def trace_region(tech:pya.NetTracerConnectivity, layout:pya.Layout, layout_cell:
 
   return(merged_region)
 
+def parse_shard(shard:str) -> tuple:
+  """
+  "i/N"形式のshard指定を(i,N)に変換(iは1から)
+  """
+  m = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", str(shard))
+  if not m or not (1 <= int(m.group(1)) <= int(m.group(2))):
+    print(f"[ERR]: shard must be i/N (1<=i<=N). ({shard})")
+    sys.exit(1)
+  return int(m.group(1)), int(m.group(2))
 
-# ------------------------
-# klayout(main)
-# ------------------------
-#in_gds="in_sample.gds"
-#in_jsonc_gdslayer="in_gdslayer.jsonc"
-#in_jsonc_tech="in_tech.jsonc"
-#in_jsonc_macro="in_macro.jsonc"
-#out_lef_tech="tech.lef"
-#out_lef_macro="macro.lef"
+def cell_complexity(layout:pya.Layout) -> dict:
+  """
+  セル毎の処理量の見積り(flatten後の図形数)を返す
+    {cell_index: 図形数}
+  """
+  cost={}
+  for ci in layout.each_cell_bottom_up():
+    cell = layout.cell(ci)
+    n = sum(cell.shapes(li).size() for li in layout.layer_indexes())
+    for inst in cell.each_inst():
+      n += cost.get(inst.cell_index, 0) * inst.size()
+    cost[ci] = n
+  return cost
+
+def assign_shards(names:list, cost:dict, n_shards:int) -> list:
+  """
+  namesをn_shards個に分割(見積り処理量が均等になるよう、大きい順に最も空いているshardへ割当)
+    names: 処理順のセル名, cost: {セル名: 処理量}
+    戻り値: shard毎のセル名のset
+  """
+  order  = {n:i for i,n in enumerate(names)}
+  shards = [set() for i in range(n_shards)]
+  loads  = [0] * n_shards
+  for name in sorted(names, key=lambda n: (-cost[n], order[n])):
+    i = loads.index(min(loads))
+    shards[i].add(name)
+    loads[i] += cost[name] + 1
+  return shards
+
+def render_macro_lef(macro_name:str, macro_info:dict, abstract:dict, dbu:float) -> list:
+  """
+  macro abstract(整数DBUの形状/アンテナ面積)とmacro.jsoncの属性からMACROのLEF行を作成
+  """
+  outlines = []
+  outlines.append(f"MACRO {macro_name}")
 
-#-- set inital input/output file
-if 'in_jsonc_gdslayer' not in globals():
-  in_jsonc_gdslayer="config.pya_gds2lef/in_gdslayer.jsonc"
-if 'in_jsonc_tech' not in globals():
-  in_jsonc_tech    ="config.pya_gds2lef/in_tech.jsonc"
-if 'in_jsonc_macro' not in globals():
-  in_jsonc_macro   ="config.pya_gds2lef/in_macro.jsonc"
-if 'in_gds' not in globals():
-  in_gds           ="config.pya_gds2lef/sg13g2_stdcell.gds"
+  ##-- BOUNDARY
+  b_box = abstract["boundary"]
+  w=(b_box[2] - b_box[0]) * dbu
+  h=(b_box[3] - b_box[1]) * dbu
 
-if 'out_lef_macro' not in globals():
-  out_lef_macro    ="out_macro.lef"
+  bottom_x=b_box[0] * dbu
+  bottom_y=b_box[1] * dbu
   
-#check var & file
-for f in [in_gds, in_jsonc_gdslayer,  in_jsonc_tech, in_jsonc_macro]:
-  if not os.path.isfile(f):
-    print(f"[ERROR]: Input file '{f}' does not exist.", file=sys.stderr)
-    sys.exit(1)
-
-#-- print parameter & read json files
-if True:
-  print(f"[INF]: in_jsonc_tech    ={in_jsonc_tech}")
-  tech_dict=load_json_with_comments(in_jsonc_tech)
+  outlines.append(f"  ORIGIN 0 0 ;")
+  outlines.append(f"  FOREIGN {macro_name} {bottom_x} {bottom_y} ;")
+  #outlines.append(f"  FOREIGN 0 0 ;")
+  
+  lines=[]
+  for kk,vv in macro_info.items():
+    if kk=="PIN":
+      continue
+    if vv is not None:
+      lines.extend(conv_dict2lef(param={kk:vv}, hier=1))
+  outlines.extend(lines)
 
-  print(f"[INF]: in_jsonc_macro   ={in_jsonc_macro}")
-  macro_dict=load_json_with_comments(in_jsonc_macro)
+  #--- othres
+  outlines.append(f"  SIZE {w:.3f} BY {h:.3f} ;")
+  
+  #--- PIN
+  if not "PIN" in macro_info.keys():
+    print(f"[ERROR] PIN is not defined in {macro_name}")
+    sys.exit()
 
-  print(f"[INF]: in_jsonc_gdslayer={in_jsonc_gdslayer}")
-  gdslayer_dict=load_json_with_comments(in_jsonc_gdslayer)
+  pin_info_dict=macro_info["PIN"]
+  for pin_name,pin_params in pin_info_dict.items():
 
-  print(f"[INF]: in_gds           ={in_gds}")
-  
-if 'out_lef_tech' not in globals():
-  out_lef_tech = None
+    #-- check if pin is exist in GDS
+    if pin_name not in abstract["ports"].keys():
+      print(f"[ERR] {pin_name} is not exist in GDS.")
+      sys.exit()
+      
+    #-- write data  for PIN
+    layer_rects=abstract["ports"][pin_name]
+    outlines.append(f"  PIN {pin_name}")
+    
+    #-- write data from macro.json
+    lines=[]
+    for kk,vv in pin_params.items():
+      if vv is not None:
+        lines.extend(conv_dict2lef(param={kk:vv}, hier=2))
+    outlines.extend(lines)
+      
+    #-- write data for ANTENNAGATEAREA
+    for layer, area in abstract["gate_area"].get(pin_name, {}).items():
+      outlines.append(f"    ANTENNAGATEAREA {area * (dbu * dbu):.3f} LAYER {layer} ;")
+    
+    #-- write data for ANTENNADIFFAREA
+    for layer, area in abstract["diff_area"].get(pin_name, {}).items():
+      outlines.append(f"    ANTENNADIFFAREA {area * (dbu * dbu):.3f} LAYER {layer} ;")
+    
+    #-- write data for port
+    outlines.append(f"    PORT")
+    
+    for layer in sorted(layer_rects.keys()):
+      if len(layer_rects[layer])<1:
+        continue
+    
+      outlines.append(f"      LAYER {layer} ;")
+      for x1, y1, x2, y2 in layer_rects[layer]:
+        outlines.append(f"        RECT {x1*dbu:.3f} {y1*dbu:.3f} {x2*dbu:.3f} {y2*dbu:.3f} ;")
+        
+      outlines.append(f"    END"); #PORT
+      
+    outlines.append(f"  END {pin_name}"); #PIN
+    
+  #--- OBS
+  if len(abstract["obs"])>0:
+    outlines.append(f"  OBS"); 
+    for obs_name, rects in abstract["obs"].items():
+      outlines.append(f"    LAYER {obs_name} ;")
+      for x1, y1, x2, y2 in rects:
+        outlines.append(f"        RECT {x1*dbu:.3f} {y1*dbu:.3f} {x2*dbu:.3f} {y2*dbu:.3f} ;")
+    outlines.append(f"  END"); 
 
-print(f"[INF]: out_lef_macro    ={out_lef_macro}")
-if out_lef_tech:
-  print(f"[INF]: out_lef_tech     ={out_lef_tech}")
+  ##-- end of MACRO
+  outlines.append(f"END {macro_name}"); #MACRO
+  outlines.append(f"");
 
+  return outlines
 
-#-- write tech lef
-write_lef_tech (tech_dict=tech_dict, tlef=out_lef_tech, mlef=out_lef_macro)
+# ------------------------
+# macro abstract file
+# ------------------------
+#   header : magic(8s) json_size(Q)
+#   json   : {"version", "dbu", "macros": {name: {"boundary", "ports": {pin: {layer: [start, count]}},
+#                                                 "gate_area", "diff_area", "obs": {layer: [start, count]}}}}
+#   rects  : int32 array(little endian), 4 values(x1 y1 x2 y2) per rect
+ABSTRACT_MAGIC   = b"PYAABS01"
+ABSTRACT_HEADER  = struct.Struct("<8sQ")
+ABSTRACT_VERSION = 1
+
+def write_abstracts(path:str, abstracts:dict, dbu:float):
+  """
+  macro abstractをファイルへ保存(rectは整数配列にまとめる)
+  """
+  data = array("i")
+  def to_range(rects:list) -> list:
+    start = len(data) // 4
+    for rect in rects:
+      data.extend(rect)
+    return [start, len(rects)]
+
+  macros = {}
+  for name, abstract in abstracts.items():
+    macros[name] = {
+      "boundary" : abstract["boundary"],
+      "ports"    : {pin: {layer: to_range(rects) for layer, rects in layers.items()} for pin, layers in abstract["ports"].items()},
+      "gate_area": abstract["gate_area"],
+      "diff_area": abstract["diff_area"],
+      "obs"      : {layer: to_range(rects) for layer, rects in abstract["obs"].items()},
+    }
+
+  header = json.dumps({"version": ABSTRACT_VERSION, "dbu": dbu, "macros": macros}, separators=(",", ":")).encode("utf-8")
+  if sys.byteorder != "little":
+    data.byteswap()
+
+  tmp_path = f"{path}.tmp"
+  with open(tmp_path, "wb") as f:
+    f.write(ABSTRACT_HEADER.pack(ABSTRACT_MAGIC, len(header)))
+    f.write(header)
+    data.tofile(f)
+  os.replace(tmp_path, path)
+
+def read_abstracts(path:str) -> tuple:
+  """
+  write_abstractsで保存したmacro abstractを読み込む
+    戻り値: (abstracts, dbu)
+  """
+  with open(path, "rb") as f:
+    magic, header_size = ABSTRACT_HEADER.unpack(f.read(ABSTRACT_HEADER.size))
+    if magic != ABSTRACT_MAGIC:
+      print(f"[ERR]: {path} is not a macro abstract file.")
+      sys.exit(1)
+    header = json.loads(f.read(header_size).decode("utf-8"))
+    data = array("i")
+    data.frombytes(f.read())
+  if header["version"] != ABSTRACT_VERSION:
+    print(f"[ERR]: version of {path} is not supported({header['version']}).")
+    sys.exit(1)
+  if sys.byteorder != "little":
+    data.byteswap()
+
+  def to_rects(start:int, count:int) -> list:
+    return [data[i*4:i*4+4].tolist() for i in range(start, start + count)]
+
+  abstracts = OrderedDict()
+  for name, m in header["macros"].items():
+    abstracts[name] = {
+      "boundary" : m["boundary"],
+      "ports"    : {pin: {layer: to_rects(*r) for layer, r in layers.items()} for pin, layers in m["ports"].items()},
+      "gate_area": m["gate_area"],
+      "diff_area": m["diff_area"],
+      "obs"      : {layer: to_rects(*r) for layer, r in m["obs"].items()},
+    }
+  return abstracts, header["dbu"]
+
+def parse_size(size:str) -> int:
+  """
+  サイズ指定(ex: 500M, 2G)をbyte数に変換
+  """
+  m = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*", str(size).upper())
+  if not m:
+    print(f"[ERR]: illegal size format. ({size})")
+    sys.exit(1)
+  return int(float(m.group(1)) * 1024 ** " KMGT".index(m.group(2) or " "))
 
-#-- read gds & flatten
-layout = pya.Layout()
-layout.read(in_gds)
+def current_rss() -> int:
+  """
+  現在のRSS(byte)。取得できない場合は0
+  """
+  try:
+    with open("/proc/self/statm") as f:
+      return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except (OSError, ValueError, AttributeError):
+    return 0
+
+RunPlan = namedtuple("RunPlan", ["layer_info", "create", "connect_text", "connect_gate_diff", "obs", "macro_pins"])
+RunPlan.__doc__ = """
+  gdslayer/macro jsoncから作成した検証済みの実行計画(全macroで共有)
+    layer_info       : {レイヤ名: (layer, datatype)}
+    create           : {派生レイヤ名: compile済みの式}
+    connect_text     : {metal名: (text名, pin名 or None, space_um)}
+    connect_gate_diff: ((レイヤ名, レイヤ名), ...)
+    obs              : (OBSのレイヤ名, ...)
+    macro_pins       : {macro名: {PIN名: PinPolicy}}
+"""
+
+PIN_POLICY_MATCH = ("USE", "DIRECTION", "SHAPE")
+PinPolicy = namedtuple("PinPolicy", ["gate_area", "diff_area", "port"])
+PinPolicy.__doc__ = """
+  PIN毎の抽出方針(macro jsoncのPIN_POLICYをPINのUSE/DIRECTION/SHAPEで照合)
+    gate_area: ANTENNAGATEAREAをtraceする
+    diff_area: ANTENNADIFFAREAをtraceする
+    port     : "FULL"(全形状) or "ABUTMENT"(セル境界に接するrailのみ)
+"""
+DEFAULT_PIN_POLICY = PinPolicy(gate_area=True, diff_area=True, port="FULL")
+
+def compile_run_plan(gdslayer_dict:dict, macro_dict:dict) -> RunPlan:
+  """
+  gdslayer/macro jsoncを検証しRunPlanを作成(GDSを読む前に実行)
+  設定の誤りはまとめてValueErrorで返す
+  """
+  errors=[]
+  def section(name:str, default):
+    if name not in gdslayer_dict:
+      errors.append(f"{name} is not defined in gdslayer jsonc.")
+      return default
+    return gdslayer_dict[name]
+
+  #-- GDS_LAYER_INFO
+  layer_info=OrderedDict()
+  for ly_name, ly_num_type in section("GDS_LAYER_INFO", {}).items():
+    if not (isinstance(ly_num_type, list) and len(ly_num_type) == 2 and all(isinstance(v, int) for v in ly_num_type)):
+      errors.append(f"GDS_LAYER_INFO[{ly_name}] must be [layer, datatype]. ({ly_num_type})")
+      continue
+    layer_info[ly_name] = tuple(ly_num_type)
+  if "BOUNDARY" not in layer_info:
+    errors.append(f"BOUNDARY is not defined in GDS_LAYER_INFO.")
 
-#for c in layout.each_cell():
-#  for i in c.each_inst():
-#    i.flatten()
+  #-- GDS_LAYER_CREATE
+  create=OrderedDict()
+  for ly_name, expr in section("GDS_LAYER_CREATE", {}).items():
+    try:
+      create[ly_name] = compile(expr, f"GDS_LAYER_CREATE[{ly_name}]", "eval")
+    except SyntaxError as e:
+      errors.append(f"GDS_LAYER_CREATE[{ly_name}] is illegal expression. ({e.msg})")
+      continue
+    for ref in re.findall(r"gds_regions\[\s*[\"']([^\"']+)[\"']\s*\]", expr):
+      if ref not in layer_info and ref not in create:
+        errors.append(f"GDS_LAYER_CREATE[{ly_name}] refers to undefined layer {ref}.")
+  layer_names = set(layer_info) | set(create)
+
+  #-- GDS_LAYER_CONNECT_TEXT
+  connect_text=OrderedDict()
+  for metal_name, text_pin_list in section("GDS_LAYER_CONNECT_TEXT", {}).items():
+    if not (isinstance(text_pin_list, list) and len(text_pin_list) == 3):
+      errors.append(f"GDS_LAYER_CONNECT_TEXT[{metal_name}] must be [text, pin, space]. ({text_pin_list})")
+      continue
+    text_name, pin_name, space_um = text_pin_list
+    for name in (metal_name, text_name, pin_name):
+      if name is not None and name not in layer_info:
+        errors.append(f"GDS_LAYER_CONNECT_TEXT[{metal_name}]: {name} is not defined in GDS_LAYER_INFO.")
+    if not isinstance(space_um, (int, float)):
+      errors.append(f"GDS_LAYER_CONNECT_TEXT[{metal_name}]: space must be number. ({space_um})")
+      continue
+    connect_text[metal_name] = (text_name, pin_name, space_um)
 
-#-- get parameter from GDS    
-top_cells=layout.top_cells()
-dbu_gds = layout.dbu
+  #-- GDS_LAYER_CONNECT_GATE_DIFF
+  connect_gate_diff=[]
+  for pair in section("GDS_LAYER_CONNECT_GATE_DIFF", []):
+    if not (isinstance(pair, list) and len(pair) == 2):
+      errors.append(f"GDS_LAYER_CONNECT_GATE_DIFF entry must be [layer, layer]. ({pair})")
+      continue
+    for name in pair:
+      if name not in layer_names:
+        errors.append(f"GDS_LAYER_CONNECT_GATE_DIFF: {name} is not defined in GDS_LAYER_INFO/GDS_LAYER_CREATE.")
+    connect_gate_diff.append(tuple(pair))
+
+  #-- GDS_LAYER_OBS
+  obs=[]
+  for obs_name in section("GDS_LAYER_OBS", []):
+    if obs_name not in layer_info:
+      errors.append(f"GDS_LAYER_OBS: {obs_name} is not defined in GDS_LAYER_INFO.")
+      continue
+    obs.append(obs_name)
 
-if not "BOUNDARY" in gdslayer_dict["GDS_LAYER_INFO"].keys():
-  print(f"[ERROR] BOUNDARY_LAYER is not exist in {gdslayer}.")
-  sys.exit()
+  #-- PIN_POLICY: rules are applied in order to pins matching all of USE/DIRECTION/SHAPE
+  policy_rules=[]
+  for rule in macro_dict.get("PIN_POLICY", []):
+    if not isinstance(rule, dict):
+      errors.append(f"PIN_POLICY entry must be object. ({rule})")
+      continue
+    match ={}
+    action={}
+    for key, value in rule.items():
+      if key in PIN_POLICY_MATCH:
+        match[key] = {str(v).upper() for v in (value if isinstance(value, list) else [value])}
+      elif key in ("ANTENNAGATEAREA", "ANTENNADIFFAREA"):
+        if not isinstance(value, bool):
+          errors.append(f"PIN_POLICY: {key} must be true/false. ({value})")
+          continue
+        action["gate_area" if key == "ANTENNAGATEAREA" else "diff_area"] = value
+      elif key == "PORT":
+        if value not in ("FULL", "ABUTMENT"):
+          errors.append(f"PIN_POLICY: PORT must be FULL or ABUTMENT. ({value})")
+          continue
+        action["port"] = value
+      else:
+        errors.append(f"PIN_POLICY: unknown key {key}.")
+    policy_rules.append((match, action))
+
+  #-- MACRO/PIN
+  macro_pins=OrderedDict()
+  for macro_name, macro_info in macro_dict.get("MACRO", {}).items():
+    if not isinstance(macro_info, dict) or not isinstance(macro_info.get("PIN"), dict):
+      errors.append(f"PIN is not defined in MACRO {macro_name}.")
+      continue
+    macro_pins[macro_name] = OrderedDict()
+    for pin_name, pin_params in macro_info["PIN"].items():
+      policy = DEFAULT_PIN_POLICY
+      for match, action in policy_rules:
+        if all(str((pin_params or {}).get(key, "")).upper() in values for key, values in match.items()):
+          policy = policy._replace(**action)
+      macro_pins[macro_name][pin_name] = policy
+  if "MACRO" not in macro_dict:
+    errors.append(f"MACRO is not defined in macro jsonc.")
+
+  if errors:
+    raise ValueError("\n".join(errors))
+
+  return RunPlan(layer_info=layer_info, create=create, connect_text=connect_text,
+                 connect_gate_diff=tuple(connect_gate_diff), obs=tuple(obs), macro_pins=macro_pins)
+
+def bind_run_plan(plan:RunPlan, layout:pya.Layout) -> dict:
+  """
+  RunPlanのレイヤ名をlayoutのlayer indexへ解決し、NetTracerConnectivityを作成(layoutを読む毎に1回)
+    戻り値: {"index": {レイヤ名: layer index}, "tech": NetTracerConnectivity}
+  """
+  index  ={}
+  symbols=OrderedDict()
+  for ly_name, (ly_num, ly_type) in plan.layer_info.items():
+    index[ly_name]   = layout.layer(ly_num, ly_type)
+    symbols[ly_name] = f"{ly_num}/{ly_type}"
+
+  ##-- derived layers: shared by all macros (shapes are inserted into each macro cell)
+  for ly_name in plan.create.keys():
+    new_layer_info   = get_unused_layer_info(layout)
+    index[ly_name]   = layout.insert_layer(new_layer_info)
+    symbols[ly_name] = f"{new_layer_info.layer}/{new_layer_info.datatype}"
 
-#-- write macro lef(site)
-write_lef_macro_site (macro_dict=macro_dict, mlef=out_lef_macro)
+  ##-- create symbol
+  tech4port = pya.NetTracerConnectivity()
+  for symbol_name, symbol_val in symbols.items():
+    tech4port.symbol(symbol_name, symbol_val)
 
-#-- write macro lef(macro)
-for cell in top_cells:   #-- search all cell
+  ##-- connect symbols for TEXT/MEAL, GATE/DIFF
+  for metal_name, (text_name, pin_name, space_um) in plan.connect_text.items():
+    tech4port.connection(metal_name, text_name)
+  for layer1, layer2 in plan.connect_gate_diff:
+    tech4port.connection(layer1, layer2)
 
-  #-- if not defined in"MACRO", skip
-  if not cell.name in macro_dict["MACRO"].keys():
-    print(f"[INF]: skipping {cell.name}")
-    continue;
+  return {"index": index, "tech": tech4port}
 
-  #-- 
-  macro_name  = cell.name
-  macro_info  = macro_dict["MACRO"][macro_name]
-  #layout_cell = next((c for c in layout.top_cells() if c.name == macro_name), None)
+def abutment_rails(region:pya.Region, b_box:pya.Box) -> pya.Region:
+  """
+  portのregionのうち、セル境界(b_box)の辺に接する矩形(abutment rail)のみを返す
+  """
+  rails=pya.Region()
+  for r in split_manhattan_region_to_rects(region):
+    if (r.bottom <= b_box.bottom <= r.top or r.bottom <= b_box.top <= r.top or
+        r.left <= b_box.left <= r.right or r.left <= b_box.right <= r.right):
+      rails.insert(r)
+  return rails.merged()
+
+def extract_macro_abstract(layout:pya.Layout, layout_cell:pya.Cell, plan:RunPlan, binding:dict, release:bool=False) -> dict:
+  """
+  GDSのセル(layout_cell)からmacro abstract(整数DBUの形状/アンテナ面積)を抽出
+    plan/binding: compile_run_plan/bind_run_planの結果(全macroで共有)
+    release: 抽出後にflattenしたセル(派生レイヤの図形を含む)を削除(mem_budget)
+  """
+  macro_name = layout_cell.name
+  dbu_gds    = layout.dbu
+  index      = binding["index"]
+  pin_policy = plan.macro_pins.get(macro_name, {})
 
-  layout_cell=cell
-  
   print(f"[INF] target macro={macro_name}")
 
   ####################################################################
   #--get PORT positon in MACRO
   
   port_layer_pos_list={}
-  #print(gdslayer_dict["GDS_LAYER_CONNECT_TEXT"])
-  #for metal_name, text_name in gdslayer_dict["GDS_LAYER_CONNECT_TEXT"].items():
-  for metal_name, text_pin_list in gdslayer_dict["GDS_LAYER_CONNECT_TEXT"].items():
-    #-- get text_name/pin_name
-    if len(text_pin_list) != 3:
-      print(f"[ERR]: length of GDS_LAYER_CONNECT_TEXT={len(text_pin_list)}. It must be 3.")
-      sys.exit()
-    
-    text_name=text_pin_list[0]
-    pin_name =text_pin_list[1]
-    space_um =text_pin_list[2]
-    
-    index_text_layer  = layout.layer( gdslayer_dict["GDS_LAYER_INFO"][text_name])
+  for metal_name, (text_name, pin_name, space_um) in plan.connect_text.items():
 
     ##-- search text shapes with depth=0(only top cell)
-    shape_itrs = layout_cell.begin_shapes_rec(index_text_layer)
+    shape_itrs = layout_cell.begin_shapes_rec(index[text_name])
     shape_itrs.max_depth=0
 
     for shape_itr in shape_itrs:
@@ -673,56 +991,26 @@ for cell in top_cells:   #-- search all cell
   #  i.flatten()
   
   ####################################################################
-  ##-- create new layer for signal-connection
+  ##-- get region from GDS, create derived layers (layer indexes are resolved in binding)
 
   gds_regions={}
-  symbol_name_val_index={}
-  ### - get reagion from GDS
-  for ly_name,ly_num_type in gdslayer_dict["GDS_LAYER_INFO"].items():
-    layer_info  = pya.LayerInfo(ly_num_type[0], ly_num_type[1])
-    layer_index = layout.find_layer(layer_info)
-
-    if layer_index is None:
-      continue
-  
+  for ly_name in plan.layer_info.keys():
     region=pya.Region()
-    region.insert(layout_cell.shapes(layer_index))
+    region.insert(layout_cell.shapes(index[ly_name]))
     gds_regions[ly_name]=region
 
-    symbol_name_val_index[ly_name]=[f"{ly_num_type[0]}/{ly_num_type[1]}",layer_index]
-
-    #print(f"[DBG]: name={ly_name}, index={layer_index}")
-    
-  ### - create reagion, write back to cell
-  for ly_name,expr in gdslayer_dict["GDS_LAYER_CREATE"].items():
-    new_region=eval(expr)
-    
-    new_layer_info  = get_unused_layer_info(layout)
-    new_layer_index = layout.insert_layer(new_layer_info)
-    
-    new_region.insert_into(layout, layout_cell.cell_index(), new_layer_index)
+  for ly_name,code in plan.create.items():
+    new_region=eval(code, {"pya": pya, "gds_regions": gds_regions})
+    new_region.insert_into(layout, layout_cell.cell_index(), index[ly_name])
     gds_regions[ly_name]=new_region
 
-    symbol_name_val_index[ly_name]=[f"{new_layer_info.layer}/{new_layer_info.datatype}",new_layer_index]
-
-    #print(f"[DBG]: name={ly_name}, index={new_layer_index}")
-    
-  ####################################################################
-
-  ##-- create symbol
-  tech4port = pya.NetTracerConnectivity()
-  for symbol_name, symbol_val_index in symbol_name_val_index.items():
-    tech4port.symbol(symbol_name, symbol_val_index[0])
-
-  ##-- connect symbols for TEXT/MEAL
-  for metal_name, text_pin_list in gdslayer_dict["GDS_LAYER_CONNECT_TEXT"].items():
-    text_name=text_pin_list[0]
-    tech4port.connection(metal_name, text_name)
+  tech4port = binding["tech"]
 
   ####################################################################
   #--search Metal around TEXT
   port_region_list={}
   region_pin_is_empty=True
+  metal_pin_regions={}
   
   for port_name in sorted_port_layer_pos_list.keys():
     for metal_name in sorted_port_layer_pos_list[port_name].keys():
@@ -731,26 +1019,22 @@ for cell in top_cells:   #-- search all cell
       points = sorted_port_layer_pos_list[port_name][metal_name]
       
       ##-- LEYER NAME
-      text_name=gdslayer_dict["GDS_LAYER_CONNECT_TEXT"][metal_name][0]
-      pin_name =gdslayer_dict["GDS_LAYER_CONNECT_TEXT"][metal_name][1]
-      space_um =gdslayer_dict["GDS_LAYER_CONNECT_TEXT"][metal_name][2]
+      text_name, pin_name, space_um = plan.connect_text[metal_name]
       
       print(f"[DBG]:   port_name={port_name}, metal_name={metal_name}, text_name={text_name}, pin_name={pin_name}")
       
-      ##--DB INDEX
-      index_metal_layer = layout.layer( gdslayer_dict["GDS_LAYER_INFO"][metal_name])
-      index_text_layer  = layout.layer( gdslayer_dict["GDS_LAYER_INFO"][text_name])
-      index_pin_layer   = layout.layer( gdslayer_dict["GDS_LAYER_INFO"][pin_name]) if pin_name else -1
-
-      ##--REGION
-      region_metal = pya.Region(layout_cell.shapes(index_metal_layer))
-      region_metal.merge()
-      
-      if index_pin_layer>-1 :
-        region_pin   = pya.Region(layout_cell.shapes(index_pin_layer)) & region_metal
-      else :
-        region_pin = pya.Region(); # empty
-      region_pin.merge()
+      ##--REGION (same for all ports on the metal)
+      if metal_name not in metal_pin_regions:
+        region_metal = pya.Region(layout_cell.shapes(index[metal_name]))
+        region_metal.merge()
+        
+        if pin_name:
+          region_pin   = pya.Region(layout_cell.shapes(index[pin_name])) & region_metal
+        else :
+          region_pin = pya.Region(); # empty
+        region_pin.merge()
+        metal_pin_regions[metal_name] = (region_metal, region_pin)
+      region_metal, region_pin = metal_pin_regions[metal_name]
       
       ##-- prepare port_region_list
       if port_name not in port_region_list:
@@ -789,12 +1073,6 @@ for cell in top_cells:   #-- search all cell
   ####################################################################
   #--get GATEAREA
   
-  ##-- connect symbols
-  for pair in gdslayer_dict["GDS_LAYER_CONNECT_GATE_DIFF"]:
-    layer1 = pair[0]
-    layer2 = pair[1]
-    tech4port.connection(layer1, layer2)
-  
   ##-- trace from PORT to GATE/DIFF
   gate_area={}
   diff_area={}
@@ -805,145 +1083,80 @@ for cell in top_cells:   #-- search all cell
       if len(points)<1:
         continue
 
+      ##-- skip traces not needed for the pin (PIN_POLICY)
+      policy = pin_policy.get(port_name, DEFAULT_PIN_POLICY)
+      if not (policy.gate_area or policy.diff_area):
+        continue
+
       ##-- use only 1 point
       start_point       = points[0]
-      layer_val_index   = symbol_name_val_index[metal_name]
-      start_layer_index = layer_val_index[1]
+      start_layer_index = index[metal_name]
 
       ###-- get GATE region & area
-      if "GATEAREA" in symbol_name_val_index.keys():
+      if "GATEAREA" in index.keys() and policy.gate_area:
             
-        layer_val_index   = symbol_name_val_index["GATEAREA"]
-        stop_layer_index  = layer_val_index[1]
+        stop_layer_index  = index["GATEAREA"]
         
         region = trace_region(tech4port, layout, layout_cell, start_point, start_layer_index, port_name, stop_layer_index)
         if region:
           if port_name not in gate_area:
             gate_area[port_name]={}
             
-          gate_area[port_name][metal_name] = region.area() * (dbu_gds * dbu_gds)
+          gate_area[port_name][metal_name] = region.area()
 
       ###-- get DIFF region & area
-      if "DIFFAREA" in symbol_name_val_index.keys():
-        layer_val_index   = symbol_name_val_index["DIFFAREA"]
-        stop_layer_index  = layer_val_index[1]
+      if "DIFFAREA" in index.keys() and policy.diff_area:
+        stop_layer_index  = index["DIFFAREA"]
         
         region = trace_region(tech4port, layout, layout_cell, start_point, start_layer_index, port_name, stop_layer_index)
         if region:
           if port_name not in diff_area:
             diff_area[port_name]={}
             
-          diff_area[port_name][metal_name] = region.area() * (dbu_gds * dbu_gds)
+          diff_area[port_name][metal_name] = region.area()
 
-  #-- write lef
-  outlines = []
-  outlines.append(f"MACRO {macro_name}")
+  #-- macro abstract(integer DBU)
+  abstract = {"boundary": None, "ports": {}, "gate_area": {}, "diff_area": {}, "obs": {}}
 
   ##-- BOUNDARY
-  layer_boundary_num      = gdslayer_dict["GDS_LAYER_INFO"]["BOUNDARY"][0]
-  layer_boundary_datatype = gdslayer_dict["GDS_LAYER_INFO"]["BOUNDARY"][1]
-  layer_boundary_info=layout.layer(layer_boundary_num, layer_boundary_datatype)
-  boundary_region = pya.Region(layout_cell.shapes(layer_boundary_info)).merged()
+  boundary_region = pya.Region(layout_cell.shapes(index["BOUNDARY"])).merged()
   if boundary_region.is_empty():
     print(f"[ERR]: boundary layer is not exist in {macro_name}.")
     sys.exit()
     
   b_box=boundary_region.bbox()
-  w=b_box.width()  * dbu_gds
-  h=b_box.height() * dbu_gds
+  abstract["boundary"] = [b_box.left, b_box.bottom, b_box.right, b_box.top]
 
-  bottom_x=b_box.p1.x  *dbu_gds
-  bottom_y=b_box.p1.y  *dbu_gds
-  
-  outlines.append(f"  ORIGIN 0 0 ;")
-  outlines.append(f"  FOREIGN {macro_name} {bottom_x} {bottom_y} ;")
-  #outlines.append(f"  FOREIGN 0 0 ;")
-  
-  lines=[]
-  for kk,vv in macro_info.items():
-    if kk=="PIN":
+  ##-- PORT ABUTMENT: keep only rails on the cell boundary (other shapes become OBS)
+  for port_name in port_region_list.keys():
+    if pin_policy.get(port_name, DEFAULT_PIN_POLICY).port != "ABUTMENT":
       continue
-    if vv is not None:
-      lines.extend(conv_dict2lef(param={kk:vv}, hier=1))
-  outlines.extend(lines)
-
-  #--- othres
-  outlines.append(f"  SIZE {w:.3f} BY {h:.3f} ;")
-  
-  #--- PIN
-  if not "PIN" in macro_info.keys():
-    print(f"[ERROR] PIN is not defined in {macro_json}")
-    sys.exit()
-
-  pin_info_dict=macro_info["PIN"]
-  for pin_name,pin_params in pin_info_dict.items():
-
-    #-- check if pin is exist in GDS
-    #print (port_region_list)
-    if pin_name not in port_region_list.keys():
-      print(f"[ERR] {pin_name} is not exist in GDS.")
-      sys.exit()
-      
-    #-- write data  for PIN
-    layer_region=port_region_list[pin_name]
-    outlines.append(f"  PIN {pin_name}")
-    
-    #-- write data from macro.json
-    lines=[]
-    for kk,vv in pin_params.items():
-      if vv is not None:
-        lines.extend(conv_dict2lef(param={kk:vv}, hier=2))
-    outlines.extend(lines)
-      
-    #-- write data for ANTENNAGATEAREA
-    if pin_name in gate_area.keys():
-      for layer in gate_area[pin_name].keys():
-        area = gate_area[pin_name][layer]
-        outlines.append(f"    ANTENNAGATEAREA {area:.3f} LAYER {layer} ;")
-    
-    #-- write data for ANTENNADIFFAREA
-    if pin_name in diff_area.keys():
-      for layer in diff_area[pin_name].keys():
-        area = diff_area[pin_name][layer]
-        outlines.append(f"    ANTENNADIFFAREA {area:.3f} LAYER {layer} ;")
-    
-    #-- write data for port
-    outlines.append(f"    PORT")
-    
-    layers = sorted(layer_region.keys())
-    for layer in layers:
-      if len(layer_region[layer])<1:
-        continue
-    
-      outlines.append(f"      LAYER {layer} ;")
-
-      for r in layer_region[layer]:
-        #rects=split_manhattan_region_to_rects(layer_region[layer])
-        rects=split_manhattan_region_to_rects(r)
-        for rect in rects:
-          #print(f"[DEBUG] {pin_name} {rect}")
-          x1 = rect.left    * dbu_gds
-          y1 = rect.bottom  * dbu_gds
-          x2 = rect.right   * dbu_gds
-          y2 = rect.top     * dbu_gds
-        
-          outlines.append(f"        RECT {x1:.3f} {y1:.3f} {x2:.3f} {y2:.3f} ;")
-        
-      outlines.append(f"    END"); #PORT
-      
-    outlines.append(f"  END {pin_name}"); #PIN
+    rails = {layer: [abutment_rails(r, b_box) for r in regions] for layer, regions in port_region_list[port_name].items()}
+    if all(r.is_empty() for regions in rails.values() for r in regions):
+      print(f"[INF]: no abutment rail for {port_name}, full shapes are used.")
+      continue
+    port_region_list[port_name] = {layer: [r for r in regions if not r.is_empty()] for layer, regions in rails.items()}
+
+  ##-- PORT rects
+  for port_name in port_region_list.keys():
+    abstract["ports"][port_name] = {}
+    for layer in sorted(port_region_list[port_name].keys()):
+      rects=[]
+      for r in port_region_list[port_name][layer]:
+        rects.extend(split_manhattan_region_to_rects(r))
+      abstract["ports"][port_name][layer] = [[r.left, r.bottom, r.right, r.top] for r in rects]
+
+  ##-- ANTENNAGATEAREA/ANTENNADIFFAREA
+  abstract["gate_area"] = gate_area
+  abstract["diff_area"] = diff_area
     
   #--- OBS
-  lines_obs=[]
-  #for metal_name, text_name in gdslayer_dict["GDS_LAYER_CONNECT_TEXT"].items():
-  for obs_name in gdslayer_dict["GDS_LAYER_OBS"]:
+  for obs_name in plan.obs:
     ##--- get OBS region
     if region_pin_is_empty:
-      index_obs_layer = layout.layer( gdslayer_dict["GDS_LAYER_INFO"][obs_name])
-      obs_region      = pya.Region(layout_cell.shapes(index_obs_layer))
+      obs_region      = pya.Region(layout_cell.shapes(index[obs_name]))
     else:
-      index_obs_layer = layout.layer( gdslayer_dict["GDS_LAYER_INFO"]["BOUNDARY"])
-      obs_region      = pya.Region(layout_cell.shapes(index_obs_layer))
+      obs_region      = pya.Region(layout_cell.shapes(index["BOUNDARY"]))
         
     ##-- remove port region from obs_region
     if obs_region.is_empty():
@@ -955,7 +1168,7 @@ for cell in top_cells:   #-- search all cell
       if obs_name in port_region_list[port_name].keys():
         
         #sapce between pin and OSB
-        space_um =gdslayer_dict["GDS_LAYER_CONNECT_TEXT"][obs_name][2]
+        space_um =plan.connect_text[obs_name][2]
         space    = 0 if region_pin_is_empty else space_um / dbu_gds
         
         #get pin area
@@ -980,36 +1193,543 @@ for cell in top_cells:   #-- search all cell
       continue
   
     rects=split_manhattan_region_to_rects(obs_region)
+    abstract["obs"][obs_name] = [[r.left, r.bottom, r.right, r.top] for r in rects]
 
-    
-    lines_obs.append(f"    LAYER {obs_name} ;")
-    for rect in rects:
-      #print(f"[DEBUG] {pin_name} {rect}")
-      x1 = rect.left    * dbu_gds
-      y1 = rect.bottom  * dbu_gds
-      x2 = rect.right   * dbu_gds
-      y2 = rect.top     * dbu_gds
-      
-      lines_obs.append(f"        RECT {x1:.3f} {y1:.3f} {x2:.3f} {y2:.3f} ;")
-        
-  ##-- add lines_obs
-  if len(lines_obs)>0:
-    outlines.append(f"  OBS"); 
-    outlines.extend(lines_obs); 
-    outlines.append(f"  END"); 
+  #--------------------------------------
+  #-- release flattened cell (shapes of derived layers are in the cell)
+  if release:
+    layout_cell.clear()
 
-  ##-- end of MACRO
-  outlines.append(f"END {macro_name}"); #MACRO
-  outlines.append(f"");
+  return abstract
 
+def write_lef_macros(mlef:str, abstracts:dict, macro_dict:dict, dbu:float, macro_order:list=None):
+  """
+  macro abstractからMACROのLEFを作成しmlefへ追記
+    macro_order: 指定時(shard)は各MACROの前に順序のmarkerを出力
+  """
+  for macro_name, abstract in abstracts.items():
+    if not macro_name in macro_dict["MACRO"].keys():
+      print(f"[INF]: skipping {macro_name}")
+      continue
+
+    outlines = render_macro_lef(macro_name=macro_name, macro_info=macro_dict["MACRO"][macro_name], abstract=abstract, dbu=dbu)
+
+    #--------------------------------------
+    # write to macro.lef
+    if len(outlines)>0:
+      with open(mlef, 'a') as f:
+        if macro_order is not None:
+          f.write(f"#@pya_gds2lef macro {macro_order.index(macro_name)} {len(macro_order)} {macro_name}\n")
+        s = "\n".join(outlines) + "\n"
+        f.write(s)
+
+def write_lef_atomic(tech_dict:dict, macro_dict:dict, abstracts:dict, dbu:float, tlef:str, mlef:str):
+  """
+  tech/macro LEFを一時ファイルへ書き込んでから置き換える(watch)
+  """
+  tmp_mlef = f"{mlef}.tmp"
+  tmp_tlef = (tmp_mlef if tlef == mlef else f"{tlef}.tmp") if tlef else None
+
+  write_lef_tech (tech_dict=tech_dict, tlef=tmp_tlef, mlef=tmp_mlef)
+  write_lef_macro_site (macro_dict=macro_dict, mlef=tmp_mlef)
+  write_lef_macros(tmp_mlef, abstracts, macro_dict, dbu)
+
+  if tmp_tlef and tmp_tlef != tmp_mlef:
+    os.replace(tmp_tlef, tlef)
+  os.replace(tmp_mlef, mlef)
+
+def gds_cell_hashes(path:str) -> dict:
+  """
+  GDSのセル毎のhash(子セルの内容を含む)をpya_gdsscanで計算
+  GDS以外のファイル、またはpya_gdsscanを読み込めない場合はNone
+  """
+  try:
+    with open(path, "rb") as f:
+      if f.read(4) != b"\x00\x06\x00\x02":   #-- HEADER record
+        return None
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from pya_gdsscan import scan_gds
+    cells = scan_gds(path)["cells"]
+  except (NameError, ImportError, OSError, ValueError, struct.error):
+    return None
+
+  hashes = {}
+  def cell_hash(name:str) -> str:
+    if name not in hashes:
+      hashes[name] = ""   #-- guard for recursive reference
+      h = hashlib.blake2b(digest_size=16)
+      if name in cells:
+        h.update(cells[name]["hash"].encode())
+        for child in sorted(cells[name]["children"]):
+          h.update(child.encode() + cell_hash(child).encode())
+      hashes[name] = h.hexdigest()
+    return hashes[name]
+
+  for name in cells:
+    cell_hash(name)
+  return hashes
+
+# ------------------------
+# OASIS cache of in_gds
+# ------------------------
+#   <cache_dir>/<sha1(path)[:16]>.oas  : in_gds converted to OASIS(CBLOCKs, strict mode)
+#   <cache_dir>/<sha1(path)[:16]>.json : {"version", "source", "mtime_ns", "size", "hash", "top_cells", "oas_size", "last_used"}
+OAS_CACHE_VERSION = 1
+
+def default_oas_cache_dir() -> str:
+  """
+  OASIS cacheの標準の保存先
+  """
+  base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+  return os.path.join(base, "pya_tools", "oas")
+
+def file_hash(path:str) -> str:
+  """
+  ファイル内容のhash(blake2b)
+  """
+  h = hashlib.blake2b(digest_size=16)
+  with open(path, "rb") as f:
+    for chunk in iter(lambda: f.read(16 * 1024 * 1024), b""):
+      h.update(chunk)
+  return h.hexdigest()
+
+def trim_oas_cache(cache_dir:str, max_size:int, keep:str=None):
+  """
+  OASIS cacheの合計サイズがmax_size以下になるまで、最後に使われた時刻が古いものから削除(keepは残す)
+  """
+  entries=[]
+  for name in os.listdir(cache_dir):
+    if not name.endswith(".json"):
+      continue
+    try:
+      with open(os.path.join(cache_dir, name), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+      entries.append((meta.get("last_used", 0), meta.get("oas_size", 0), os.path.join(cache_dir, name[:-5])))
+    except (OSError, ValueError):
+      continue
+
+  total = sum(e[1] for e in entries)
+  for last_used, oas_size, base in sorted(entries):
+    if total <= max_size:
+      break
+    if base == keep:
+      continue
+    for ext in (".json", ".oas"):
+      if os.path.exists(base + ext):
+        os.remove(base + ext)
+    total -= oas_size
+    print(f"[INF]: removed OASIS cache {base}.oas")
+
+def read_layout(path:str, cache_dir:str=None, cache_size:int=0) -> tuple:
+  """
+  GDSを読み込む。cache_dir指定時は、OASISへ変換したcacheがあればそれを読み、無ければ変換して保存
+  cacheはpath, mtime, サイズで照合し、mtimeのみ異なる場合は内容のhashで照合
+    戻り値: (layout, トップセル名のリスト(GDSを読んだ場合と同じ順))
+  """
+  layout = pya.Layout()
+  if not cache_dir:
+    layout.read(path)
+    return layout, [c.name for c in layout.top_cells()]
+
+  source   = os.path.abspath(path)
+  base     = os.path.join(cache_dir, hashlib.sha1(source.encode()).hexdigest()[:16])
+  st       = os.stat(path)
+  meta     = None
+  try:
+    with open(f"{base}.json", "r", encoding="utf-8") as f:
+      meta = json.load(f)
+  except (OSError, ValueError):
+    pass
+
+  #-- cache hit
+  if meta and meta.get("version") == OAS_CACHE_VERSION and meta.get("source") == source and os.path.isfile(f"{base}.oas"):
+    hit = (meta["mtime_ns"], meta["size"]) == (st.st_mtime_ns, st.st_size)
+    if not hit and meta["size"] == st.st_size and meta["hash"] == file_hash(path):
+      hit = True
+      meta["mtime_ns"] = st.st_mtime_ns
+    if hit:
+      print(f"[INF]: reading OASIS cache {base}.oas")
+      layout.read(f"{base}.oas")
+      meta["last_used"] = time.time()
+      with open(f"{base}.json", "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+      return layout, meta["top_cells"]
+
+  #-- cache miss: read GDS, save as OASIS
+  layout.read(path)
+  top_cell_names = [c.name for c in layout.top_cells()]
+
+  try:
+    os.makedirs(cache_dir, exist_ok=True)
+    options = pya.SaveLayoutOptions()
+    options.format                  = "OASIS"
+    options.oasis_write_cblocks     = True
+    options.oasis_strict_mode       = True
+    options.oasis_compression_level = 2
+    tmp_path = f"{base}.{os.getpid()}.tmp.oas"
+    layout.write(tmp_path, options)
+    os.replace(tmp_path, f"{base}.oas")
+
+    meta = {"version": OAS_CACHE_VERSION, "source": source, "mtime_ns": st.st_mtime_ns, "size": st.st_size,
+            "hash": file_hash(path), "top_cells": top_cell_names, "oas_size": os.path.getsize(f"{base}.oas"), "last_used": time.time()}
+    with open(f"{base}.json", "w", encoding="utf-8") as f:
+      json.dump(meta, f)
+    print(f"[INF]: saved OASIS cache {base}.oas ({st.st_size/(1024*1024):.1f}MB -> {meta['oas_size']/(1024*1024):.1f}MB)")
+
+    if cache_size:
+      trim_oas_cache(cache_dir, cache_size, keep=base)
+  except OSError as e:
+    print(f"[WRN]: cannot write OASIS cache in {cache_dir}: {e}")
+
+  return layout, top_cell_names
+
+def read_layouts(paths:list, cache_dir:str=None, cache_size:int=0) -> tuple:
+  """
+  複数のGDSを1つのlayoutへ読み込む(各ファイルはread_layoutで1回だけ読む)
+  2つ目以降のファイルのトップセルは階層ごとコピー(dbuは1つ目のファイルに合わせ、重複するサブセル名は"$n"付きに変更)
+  トップセル名が読み込み済みのセル名と重複する場合はValueError(全ての重複をまとめて返す)
+    戻り値: (layout, トップセル名のリスト(ファイル順))
+  """
+  layout, top_cell_names = read_layout(paths[0], cache_dir, cache_size)
+  owner  = {name: paths[0] for name in top_cell_names}
+  errors = []
+  for path in paths[1:]:
+    src, src_top_names = read_layout(path, cache_dir, cache_size)
+
+    names=[]
+    for name in src_top_names:
+      if layout.has_cell(name):
+        errors.append(f"cell {name} in {path} is already defined in {owner.get(name, 'the hierarchy of previous files')}.")
+        continue
+      names.append(name)
+
+    if names:
+      targets = [layout.create_cell(name).cell_index() for name in names]
+      cell_mapping = pya.CellMapping()
+      cell_mapping.for_multi_cells_full(layout, targets, src, [src.cell(name).cell_index() for name in names])
+      layout.copy_tree_shapes(src, cell_mapping)
+      top_cell_names.extend(names)
+      owner.update({name: path for name in names})
+    src._destroy()
+
+  if errors:
+    layout._destroy()
+    raise ValueError("\n".join(errors))
+  return layout, top_cell_names
+
+def parse_list(value) -> list:
+  """
+  -rdで与えられたカンマ区切りの文字列をリストへ変換
+  """
+  return [v.strip() for v in str(value).split(",") if v.strip()]
+
+def file_stamp(path:str) -> tuple:
+  """
+  ファイルの変更検出用(mtime, size)。ファイルが無い場合はNone
+  """
+  try:
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+  except OSError:
+    return None
+
+# ------------------------
+# klayout(main)
+# ------------------------
+#in_gds="in_sample.gds"   # comma separated list to merge libraries (ex: stdcell.gds,io.gds)
+#in_jsonc_gdslayer="in_gdslayer.jsonc"
+#in_jsonc_tech="in_tech.jsonc"
+#in_jsonc_macro="in_macro.jsonc"
+#out_lef_tech="tech.lef"
+#out_lef_macro="macro.lef"
+#out_abstract="macro.abs"  # save macro abstracts (geometry) for render
+#in_abstract="macro.abs"   # render LEF from abstracts without reading GDS
+#oas_cache=1      # read in_gds through OASIS cache(1: ~/.cache/pya_tools/oas, or cache directory)
+#oas_cache_size="20G"  # size cap of OASIS cache(remove least recently used)
+#watch=1          # keep running, re-extract changed macros and rewrite LEF when in_gds/jsonc files change
+#watch_interval=1 # polling interval(sec) of watch
+#mem_budget="8G"  # release each macro after use, reload GDS when RSS exceeds 8GB
+#shard="1/4"    # process only 1st of 4 shards, write <out_lef_macro>.shard1of4 (merge: python -m pya_tools --merge-lef <out_lef_macro>)
+
+#-- set inital input/output file
+if 'in_jsonc_gdslayer' not in globals():
+  in_jsonc_gdslayer="config.pya_gds2lef/in_gdslayer.jsonc"
+if 'in_jsonc_tech' not in globals():
+  in_jsonc_tech    ="config.pya_gds2lef/in_tech.jsonc"
+if 'in_jsonc_macro' not in globals():
+  in_jsonc_macro   ="config.pya_gds2lef/in_macro.jsonc"
+if 'in_gds' not in globals():
+  in_gds           ="config.pya_gds2lef/sg13g2_stdcell.gds"
+
+if 'out_lef_macro' not in globals():
+  out_lef_macro    ="out_macro.lef"
+  
+if 'in_abstract' not in globals():
+  in_abstract = None
+if 'out_abstract' not in globals():
+  out_abstract = None
+
+in_gds_files = parse_list(in_gds)
+
+#check var & file
+for f in ([in_abstract] if in_abstract else in_gds_files) + [in_jsonc_gdslayer,  in_jsonc_tech, in_jsonc_macro]:
+  if not os.path.isfile(f):
+    print(f"[ERROR]: Input file '{f}' does not exist.", file=sys.stderr)
+    sys.exit(1)
+
+#-- print parameter & read json files
+if True:
+  print(f"[INF]: in_jsonc_tech    ={in_jsonc_tech}")
+  tech_dict=load_json_with_comments(in_jsonc_tech)
+
+  print(f"[INF]: in_jsonc_macro   ={in_jsonc_macro}")
+  macro_dict=load_json_with_comments(in_jsonc_macro)
+
+  print(f"[INF]: in_jsonc_gdslayer={in_jsonc_gdslayer}")
+  gdslayer_dict=load_json_with_comments(in_jsonc_gdslayer)
+
+  if in_abstract:
+    print(f"[INF]: in_abstract      ={in_abstract}")
+  else:
+    for f in in_gds_files:
+      print(f"[INF]: in_gds           ={f}")
+
+#-- compile run plan (config errors are reported before reading GDS)
+try:
+  plan = compile_run_plan(gdslayer_dict, macro_dict)
+except ValueError as e:
+  for line in str(e).splitlines():
+    print(f"[ERR]: {line}")
+  sys.exit(1)
+  
+if 'out_lef_tech' not in globals():
+  out_lef_tech = None
+
+if 'shard' not in globals():
+  shard = None
+if 'oas_cache' not in globals() or str(oas_cache) in ("", "0"):
+  oas_cache = None
+elif str(oas_cache) == "1":
+  oas_cache = default_oas_cache_dir()
+if 'oas_cache_size' not in globals():
+  oas_cache_size = parse_size("20G")
+else:
+  oas_cache_size = parse_size(oas_cache_size)
+if 'watch' not in globals():
+  watch = False
+else:
+  watch = str(watch) not in ("", "0")
+if 'watch_interval' not in globals():
+  watch_interval = 1.0
+else:
+  watch_interval = float(watch_interval)
+if watch and (shard or in_abstract):
+  print(f"[ERR]: watch can not be used with shard/in_abstract.")
+  sys.exit(1)
+if 'mem_budget' not in globals() or str(mem_budget) in ("", "0"):
+  mem_budget = 0
+else:
+  mem_budget = parse_size(mem_budget)
+  print(f"[INF]: mem_budget       ={mem_budget/(1024*1024):.0f}MB")
+
+print(f"[INF]: out_lef_macro    ={out_lef_macro}")
+if out_lef_tech:
+  print(f"[INF]: out_lef_tech     ={out_lef_tech}")
+
+#-- shard: write MACRO blocks to fragment, header(tech/SITE) to <out_lef_macro>.head by shard 1 only
+if shard:
+  shard_i, shard_n = parse_shard(shard)
+  out_lef_head     = f"{out_lef_macro}.head"
+  out_lef_body     = f"{out_lef_macro}.shard{shard_i}of{shard_n}"
+  print(f"[INF]: shard            ={shard_i}/{shard_n} ({out_lef_body})")
+  open(out_lef_body, 'w').close()
+else:
+  out_lef_head     = out_lef_macro
+  out_lef_body     = out_lef_macro
+
+write_header = (not shard) or shard_i == 1
+
+#-- write tech lef
+if write_header:
+  write_lef_tech (tech_dict=tech_dict, tlef=out_lef_tech, mlef=out_lef_head)
+
+#-- read gds & flatten (in_abstract: render only, GDS is not read)
+abstracts = OrderedDict()
+if in_abstract:
+  if shard:
+    print(f"[ERR]: shard can not be used with in_abstract.")
+    sys.exit(1)
+  abstracts, dbu_gds = read_abstracts(in_abstract)
+  top_cells = []
+else:
+  try:
+    layout, top_cell_names = read_layouts(in_gds_files, oas_cache, oas_cache_size)
+  except ValueError as e:
+    for line in str(e).splitlines():
+      print(f"[ERR]: {line}")
+    sys.exit(1)
+
+  #for c in layout.each_cell():
+  #  for i in c.each_inst():
+  #    i.flatten()
+
+  #-- get parameter from GDS    
+  top_cells=[layout.cell(n) for n in top_cell_names]
+  dbu_gds = layout.dbu
+  binding = bind_run_plan(plan, layout)
+
+#-- write macro lef(site)
+if write_header:
+  write_lef_macro_site (macro_dict=macro_dict, mlef=out_lef_head)
+
+#-- macro order(same as single run) and shard assignment
+macro_order = [c.name for c in top_cells if c.name in macro_dict["MACRO"].keys()]
+if shard:
+  cost = cell_complexity(layout)
+  cost = {c.name: cost[c.cell_index()] for c in top_cells if c.name in macro_order}
+  shard_macros = assign_shards(macro_order, cost, shard_n)[shard_i-1]
+  print(f"[INF]: {len(shard_macros)}/{len(macro_order)} macros in shard {shard_i}/{shard_n}")
+
+#-- mem_budget: RSS does not shrink after the layout is destroyed, so the growth since the last read is budgeted
+#   (budget minus RSS after the first read). If the layout alone exceeds the budget, macros are only released.
+n_released = 0   #-- macros released since GDS was read (mem_budget)
+if mem_budget and not in_abstract:
+  rss_loaded = current_rss()
+  mem_growth = mem_budget - rss_loaded
+  if mem_growth <= 0:
+    print(f"[WRN]: RSS={rss_loaded/(1024*1024):.0f}MB after reading GDS exceeds mem_budget, GDS is not reloaded (macros are released only).")
+
+#-- extract macro abstracts
+for cell_name in [c.name for c in top_cells]:   #-- search all cell
+
+  #-- if not defined in"MACRO", skip
+  if not cell_name in macro_dict["MACRO"].keys():
+    print(f"[INF]: skipping {cell_name}")
+    continue;
+
+  #-- if not in this shard, skip
+  if shard and not cell_name in shard_macros:
+    continue
+
+  #-- mem_budget: reload GDS if released macros still occupy memory
+  if mem_budget and mem_growth > 0 and n_released > 0 and current_rss() - rss_loaded > mem_growth:
+    print(f"[INF]: RSS grew by {(current_rss() - rss_loaded)/(1024*1024):.0f}MB since GDS was read, reloading {', '.join(in_gds_files)}")
+    layout._destroy()
+    layout, top_cell_names = read_layouts(in_gds_files, oas_cache, oas_cache_size)
+    binding = bind_run_plan(plan, layout)
+    n_released = 0
+    rss_loaded = current_rss()
+
+  abstracts[cell_name] = extract_macro_abstract(layout, layout.cell(cell_name), plan, binding, release=bool(mem_budget))
+  n_released += 1
+
+#-- save abstracts
+if out_abstract:
+  write_abstracts(path=out_abstract, abstracts=abstracts, dbu=dbu_gds)
+  print(f"[INF]: {len(abstracts)} macro abstracts are saved to {out_abstract}")
+
+#-- render macro lef (shard: with marker of order for merge)
+write_lef_macros(out_lef_body, abstracts, macro_dict, dbu_gds, macro_order=macro_order if shard else None)
+
+#-- watch: re-extract only changed macros, rewrite LEF atomically
+if watch:
+  watch_files = {"tech": in_jsonc_tech, "macro": in_jsonc_macro, "gdslayer": in_jsonc_gdslayer}
+  watch_files.update({f"gds{i}": f for i, f in enumerate(in_gds_files)})
+  stamps      = {k: file_stamp(f) for k, f in watch_files.items()}
+  gds_hashes  = [gds_cell_hashes(f) for f in in_gds_files]
+  reload_pending = False   #-- GDS could not be read at the last change: reload and re-extract all
+  extracted_cells = set(abstracts)   #-- cells already flattened(and released) in the current layout
+  print(f"[INF]: watching {', '.join(watch_files.values())} (Ctrl-C to stop)")
+
+  try:
+    while True:
+      time.sleep(watch_interval)
+      changed = [k for k, f in watch_files.items() if file_stamp(f) != stamps[k]]
+      if not changed:
+        continue
+
+      #-- wait until files are written completely
+      while True:
+        new_stamps = {k: file_stamp(f) for k, f in watch_files.items()}
+        time.sleep(watch_interval)
+        if new_stamps == {k: file_stamp(f) for k, f in watch_files.items()}:
+          break
+      if None in new_stamps.values():
+        continue
+      stamps  = new_stamps
+      t_start = time.time()
+      print(f"[INF]: changed: {', '.join(watch_files[k] for k in changed)}")
+
+      #-- reload configs
+      try:
+        new_tech_dict     = load_json_with_comments(in_jsonc_tech)
+        new_macro_dict    = load_json_with_comments(in_jsonc_macro)
+        new_gdslayer_dict = load_json_with_comments(in_jsonc_gdslayer)
+        new_plan          = compile_run_plan(new_gdslayer_dict, new_macro_dict)
+      except (OSError, ValueError) as e:
+        print(f"[ERR]: failed to read jsonc files, waiting for next change. ({e})")
+        continue
+
+      extract_all = reload_pending or new_gdslayer_dict != gdslayer_dict
+      policy_changed = {n for n in new_plan.macro_pins if new_plan.macro_pins[n] != plan.macro_pins.get(n)}
+      if extract_all:
+        sections = [k for k in set(gdslayer_dict) | set(new_gdslayer_dict) if gdslayer_dict.get(k) != new_gdslayer_dict.get(k)]
+        print(f"[INF]: {in_jsonc_gdslayer} changed({', '.join(sorted(sections))}), re-extracting all macros")
+      tech_dict, macro_dict, gdslayer_dict, plan = new_tech_dict, new_macro_dict, new_gdslayer_dict, new_plan
+
+      #-- reload GDS, compare cell hashes
+      #   (a macro extracted again without GDS change also needs a fresh layout: its cell is already flattened)
+      changed_cells = set()
+      gds_changed   = any(k.startswith("gds") for k in changed)
+      stale_cells   = (policy_changed | {n for n in macro_dict["MACRO"] if n not in abstracts}) & extracted_cells
+      if gds_changed or extract_all or stale_cells:
+        try:
+          new_layout, top_cell_names = read_layouts(in_gds_files, oas_cache, oas_cache_size)
+        except ValueError as e:
+          for line in str(e).splitlines():
+            print(f"[ERR]: {line}")
+          print(f"[ERR]: waiting for next change.")
+          reload_pending = True
+          continue
+        reload_pending = False
+
+        new_hashes = [gds_cell_hashes(f) for f in in_gds_files]
+        if None in gds_hashes or None in new_hashes:
+          extract_all = extract_all or gds_changed
+        else:
+          changed_cells = {n for old, new in zip(gds_hashes, new_hashes) for n in new if new[n] != old.get(n)}
+        gds_hashes = new_hashes
+
+        layout._destroy()
+        layout = new_layout
+        binding = bind_run_plan(plan, layout)
+        n_released = 0
+        extracted_cells = set()
+        top_cells = [layout.cell(n) for n in top_cell_names]
+
+      #-- macros to extract: changed cells and macros newly defined in jsonc
+      new_abstracts = OrderedDict()
+      n_extracted   = 0
+      for cell in top_cells:
+        cell_name = cell.name
+        if not cell_name in macro_dict["MACRO"].keys():
+          continue
+        if extract_all or cell_name in changed_cells or cell_name in policy_changed or cell_name not in abstracts:
+          new_abstracts[cell_name] = extract_macro_abstract(layout, layout.cell(cell_name), plan, binding, release=bool(mem_budget))
+          extracted_cells.add(cell_name)
+          n_extracted += 1
+        else:
+          new_abstracts[cell_name] = abstracts[cell_name]
+      abstracts = new_abstracts
+
+      write_lef_atomic(tech_dict, macro_dict, abstracts, dbu_gds, tlef=out_lef_tech, mlef=out_lef_macro)
+      if out_abstract:
+        write_abstracts(path=out_abstract, abstracts=abstracts, dbu=dbu_gds)
+      print(f"[INF]: {n_extracted}/{len(abstracts)} macros re-extracted, {out_lef_macro} updated in {time.time()-t_start:.2f}s")
+
+  except KeyboardInterrupt:
+    print(f"[INF]: watch stopped")
 
-  #--------------------------------------
-  # write to macro.lef
-  if len(outlines)>0:
-    with open(out_lef_macro, 'a') as f:
-      s = "\n".join(outlines) + "\n"
-      f.write(s)
-    
 ## ------------------------
 ## 実行例（コマンドライン）
 ## ------------------------
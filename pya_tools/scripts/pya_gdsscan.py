@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#===================================================================
+# This file is associated with the pya_toos project.
+# Copyright (C) 2025 Logic-Research K.K. (Author: MATSUDA Masahiro)
+#
+# This script file is licensed under the MIT License.
+#===================================================================
+# scan GDSII records from a memory-mapped file without building a layout,
+# and write a per-cell index as JSON.
+#===================================================================
+import os, sys, json, mmap, math, struct, hashlib
+from array import array
+
+# ------------------------
+# GDSII record types
+# ------------------------
+HEADER   = 0x00
+BGNLIB   = 0x01
+LIBNAME  = 0x02
+UNITS    = 0x03
+ENDLIB   = 0x04
+BGNSTR   = 0x05
+STRNAME  = 0x06
+ENDSTR   = 0x07
+BOUNDARY = 0x08
+PATH     = 0x09
+SREF     = 0x0A
+AREF     = 0x0B
+TEXT     = 0x0C
+LAYER    = 0x0D
+DATATYPE = 0x0E
+WIDTH    = 0x0F
+XY       = 0x10
+ENDEL    = 0x11
+SNAME    = 0x12
+COLROW   = 0x13
+NODE     = 0x15
+TEXTTYPE = 0x16
+STRING   = 0x19
+STRANS   = 0x1A
+MAG      = 0x1B
+ANGLE    = 0x1C
+BOX      = 0x2D
+PATHTYPE = 0x21
+BGNEXTN  = 0x30
+ENDEXTN  = 0x31
+BOXTYPE  = 0x2E
+
+RECORD_HEAD = struct.Struct(">HBB")
+unpack_short = struct.Struct(">h").unpack_from
+
+SIMPLE_ELEMENTS = (BOUNDARY, BOX, TEXT, NODE)
+
+# ------------------------
+# functions
+# ------------------------
+def gds_real8(data: bytes) -> float:
+    """
+    GDSIIの8byte実数(excess-64, 基数16)をfloatへ変換
+    """
+    sign     = -1.0 if data[0] & 0x80 else 1.0
+    exponent = (data[0] & 0x7f) - 64
+    mantissa = int.from_bytes(data[1:8], "big") / float(1 << 56)
+    return sign * mantissa * (16.0 ** exponent)
+
+def gds_string(data: bytes) -> str:
+    """
+    GDSIIの文字列(NUL詰め)をstrへ変換
+    """
+    return data.rstrip(b"\0").decode("latin-1")
+
+def gds_int32s(data: bytes) -> array:
+    """
+    GDSIIの4byte整数列(big endian)をarrayへ変換
+    """
+    values = array("i", data)
+    if sys.byteorder == "little":
+        values.byteswap()
+    return values
+
+def merge_bbox(bbox, x1: int, y1: int, x2: int, y2: int) -> list:
+    """
+    bbox([x1,y1,x2,y2] or None)を拡張
+    """
+    if bbox is None:
+        return [x1, y1, x2, y2]
+    return [min(bbox[0], x1), min(bbox[1], y1), max(bbox[2], x2), max(bbox[3], y2)]
+
+def transform_bbox(bbox: list, ref: dict) -> list:
+    """
+    子セルのbboxを参照(SREF/AREF)の変換で変換したbboxを返す
+    """
+    angle = math.radians(ref.get("angle", 0.0))
+    mag   = ref.get("mag", 1.0)
+    mirror= ref.get("mirror", False)
+    cos_a = math.cos(angle) * mag
+    sin_a = math.sin(angle) * mag
+
+    result = None
+    for ox, oy in ref["origins"]:
+        for x, y in ((bbox[0], bbox[1]), (bbox[0], bbox[3]), (bbox[2], bbox[1]), (bbox[2], bbox[3])):
+            if mirror:
+                y = -y
+            tx = int(round(ox + x * cos_a - y * sin_a))
+            ty = int(round(oy + x * sin_a + y * cos_a))
+            result = merge_bbox(result, tx, ty, tx, ty)
+    return result
+
+def ref_origins(xy: array, colrow) -> list:
+    """
+    SREF/AREFの配置原点のリスト(AREFは四隅のみ。bbox計算にはこれで十分)
+    """
+    if colrow is None:
+        return [(xy[0], xy[1])]
+
+    cols, rows = colrow
+    x0, y0 = xy[0], xy[1]
+    dcx, dcy = (xy[2] - x0) / cols, (xy[3] - y0) / cols
+    drx, dry = (xy[4] - x0) / rows, (xy[5] - y0) / rows
+    origins = []
+    for c in (0, cols - 1):
+        for r in (0, rows - 1):
+            origins.append((x0 + c * dcx + r * drx, y0 + c * dcy + r * dry))
+    return origins
+
+def scan_gds(path: str) -> dict:
+    """
+    GDSIIファイルをmmapしてrecordを走査し、セル毎の情報を返す
+      cells: {セル名: {offset, end, bbox(子セルを含む), local_bbox, layers, labels, shapes, points, children, hash}}
+    """
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        size   = len(mm)
+        lib    = {"file": os.path.abspath(path), "size": size, "mtime": os.path.getmtime(path)}
+        cells  = {}
+        refs   = {}    # cell name -> list of reference dicts
+
+        unpack_head = RECORD_HEAD.unpack_from
+        pos  = 0
+        cell = None
+        elem = None
+        while pos + 4 <= size:
+            length, rtype, _ = unpack_head(mm, pos)
+            if length < 4:
+                raise ValueError(f"illegal record length {length} at offset {pos}")
+            data_pos = pos + 4
+            data_end = pos + length
+
+            if elem is not None:
+                #-- inside element
+                if rtype == XY:
+                    elem["xy"] = gds_int32s(mm[data_pos:data_end])
+                elif rtype == LAYER:
+                    elem["layer"] = struct.unpack_from(">h", mm, data_pos)[0]
+                elif rtype in (DATATYPE, TEXTTYPE, BOXTYPE):
+                    elem["datatype"] = struct.unpack_from(">h", mm, data_pos)[0]
+                elif rtype == ENDEL:
+                    add_element(cell, refs[cell["name"]], elem)
+                    elem = None
+                elif rtype == WIDTH:
+                    elem["width"] = abs(struct.unpack_from(">i", mm, data_pos)[0])
+                elif rtype == SNAME:
+                    elem["sname"] = gds_string(mm[data_pos:data_end])
+                elif rtype == PATHTYPE:
+                    elem["pathtype"] = struct.unpack_from(">h", mm, data_pos)[0]
+                elif rtype == BGNEXTN:
+                    elem["bgnextn"] = struct.unpack_from(">i", mm, data_pos)[0]
+                elif rtype == ENDEXTN:
+                    elem["endextn"] = struct.unpack_from(">i", mm, data_pos)[0]
+                elif rtype == COLROW:
+                    elem["colrow"] = struct.unpack_from(">hh", mm, data_pos)
+                elif rtype == STRANS:
+                    elem["mirror"] = bool(mm[data_pos] & 0x80)
+                elif rtype == MAG:
+                    elem["mag"] = gds_real8(mm[data_pos:data_end])
+                elif rtype == ANGLE:
+                    elem["angle"] = gds_real8(mm[data_pos:data_end])
+
+            elif rtype in SIMPLE_ELEMENTS:
+                #-- fast path: only layer/datatype and XY are needed, bbox is computed at ENDSTR at once
+                etype = rtype
+                layer = datatype = 0
+                while rtype != ENDEL:
+                    pos = data_end
+                    length, rtype, _ = unpack_head(mm, pos)
+                    if length < 4:
+                        raise ValueError(f"illegal record length {length} at offset {pos}")
+                    data_end = pos + length
+                    if rtype == XY:
+                        cell["xy"].append(mm[pos+4:data_end])
+                    elif rtype == LAYER:
+                        layer = unpack_short(mm, pos+4)[0]
+                    elif rtype in (DATATYPE, TEXTTYPE, BOXTYPE):
+                        datatype = unpack_short(mm, pos+4)[0]
+                cell["layers"].add((layer, datatype))
+                if etype == TEXT:
+                    cell["labels"] += 1
+                elif etype != NODE:
+                    cell["shapes"] += 1
+            elif rtype in (PATH, SREF, AREF):
+                elem = {"type": rtype}
+            elif rtype == BGNSTR:
+                cell = {"offset": pos, "bbox": None, "local_bbox": None, "layers": set(), "labels": 0, "shapes": 0, "points": 0, "children": {}, "xy": []}
+            elif rtype == STRNAME:
+                cell["name"] = gds_string(mm[data_pos:data_end])
+                cell["hash_from"] = pos   # BGNSTR has timestamps, hash from STRNAME
+                refs[cell["name"]] = []
+            elif rtype == ENDSTR:
+                cell["end"] = data_end
+                xy = gds_int32s(b"".join(cell.pop("xy")))
+                cell["points"] += len(xy) // 2
+                if xy:
+                    cell["local_bbox"] = merge_bbox(cell["local_bbox"], min(xy[0::2]), min(xy[1::2]), max(xy[0::2]), max(xy[1::2]))
+                cell["hash"] = hashlib.blake2b(mm[cell.pop("hash_from"):data_end], digest_size=16).hexdigest()
+                cells[cell.pop("name")] = cell
+                cell = None
+            elif rtype == LIBNAME:
+                lib["libname"] = gds_string(mm[data_pos:data_end])
+            elif rtype == UNITS:
+                lib["units"] = [gds_real8(mm[data_pos:data_pos+8]), gds_real8(mm[data_pos+8:data_pos+16])]
+            elif rtype == ENDLIB:
+                break
+
+            pos = data_end
+    finally:
+        mm.close()
+
+    #-- hierarchical bbox
+    def cell_bbox(name: str, stack: set):
+        c = cells.get(name)
+        if c is None or name in stack:
+            return None
+        if c["bbox"] is not None or not refs[name]:
+            return c["bbox"] if c["bbox"] is not None else c["local_bbox"]
+        stack.add(name)
+        bbox = c["local_bbox"]
+        for ref in refs[name]:
+            child = cell_bbox(ref["sname"], stack)
+            if child is not None:
+                tb = transform_bbox(child, ref)
+                bbox = merge_bbox(bbox, *tb)
+        stack.discard(name)
+        c["bbox"] = bbox
+        return bbox
+
+    used = set()
+    for name in cells:
+        cells[name]["bbox"] = cell_bbox(name, set())
+        used.update(cells[name]["children"].keys())
+
+    for c in cells.values():
+        c["layers"] = [f"{l}/{d}" for l, d in sorted(c["layers"])]
+
+    lib["top_cells"] = sorted(n for n in cells if n not in used)
+    lib["cells"]     = cells
+    return lib
+
+def add_element(cell: dict, cell_refs: list, elem: dict):
+    """
+    1要素(PATH/SREF/AREF)の情報をcellへ追加
+    """
+    rtype = elem["type"]
+    xy    = elem.get("xy")
+
+    if rtype in (SREF, AREF):
+        sname = elem.get("sname", "")
+        n     = elem["colrow"][0] * elem["colrow"][1] if rtype == AREF else 1
+        cell["children"][sname] = cell["children"].get(sname, 0) + n
+        if xy is not None:
+            ref = {"sname": sname, "origins": ref_origins(xy, elem.get("colrow") if rtype == AREF else None)}
+            for k in ("mirror", "mag", "angle"):
+                if k in elem:
+                    ref[k] = elem[k]
+            cell_refs.append(ref)
+        return
+
+    cell["shapes"] += 1
+    cell["layers"].add((elem.get("layer", 0), elem.get("datatype", 0)))
+    if xy is None or len(xy) < 2:
+        return
+
+    xs = xy[0::2]
+    ys = xy[1::2]
+    cell["points"] += len(xs)
+    if elem.get("width", 0) > 0:
+        cell["local_bbox"] = merge_bbox(cell["local_bbox"], *path_bbox(xs, ys, elem))
+    else:
+        cell["local_bbox"] = merge_bbox(cell["local_bbox"], min(xs), min(ys), max(xs), max(ys))
+
+def path_bbox(xs: array, ys: array, elem: dict) -> list:
+    """
+    PATHのbbox(幅と端の延長(PATHTYPE)を考慮)
+    """
+    hw = elem["width"] / 2
+    pathtype = elem.get("pathtype", 0)
+    if pathtype in (1, 2):
+        bgn, end = hw, hw
+    elif pathtype == 4:
+        bgn, end = elem.get("bgnextn", 0), elem.get("endextn", 0)
+    else:
+        bgn, end = 0, 0
+
+    bbox = None
+    n = len(xs)
+    if n == 1:
+        return [int(xs[0] - hw), int(ys[0] - hw), int(xs[0] + hw), int(ys[0] + hw)]
+    for i in range(n - 1):
+        dx, dy = xs[i+1] - xs[i], ys[i+1] - ys[i]
+        d = math.hypot(dx, dy) or 1.0
+        ux, uy = dx / d, dy / d
+        e0 = bgn if i == 0 else 0
+        e1 = end if i == n - 2 else 0
+        for px, py in ((xs[i] - ux * e0, ys[i] - uy * e0), (xs[i+1] + ux * e1, ys[i+1] + uy * e1)):
+            for sgn in (-1, 1):
+                x = px - uy * hw * sgn
+                y = py + ux * hw * sgn
+                bbox = merge_bbox(bbox, math.floor(x), math.floor(y), math.ceil(x), math.ceil(y))
+    return bbox
+
+def write_index(lib: dict, path: str):
+    """
+    scan_gdsの結果をJSONで書き込む
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(lib, f, indent=1)
+
+# ------------------------
+# klayout(main)
+# ------------------------
+# argument is given from klayout -rd <name>=<value> options.
+#  ex) klayout -b -r pya_gdsscan.py -rd in_gds=xxx.gds -rd out_json=xxx.gds.json
+#in_gds="sg13g2_stdcell.gds"
+#out_json="sg13g2_stdcell.gds.json"
+
+if __name__ == "__main__":
+    if 'in_gds' not in globals():
+        print(f"[ERROR]: -rd in_gds=<file> is required.", file=sys.stderr)
+        sys.exit(1)
+    if 'out_json' not in globals():
+        out_json = f"{in_gds}.json"
+
+    if not os.path.isfile(in_gds):
+        print(f"[ERROR]: Input file '{in_gds}' does not exist.", file=sys.stderr)
+        sys.exit(1)
+
+    print(f"[INF]: in_gds   ={in_gds}")
+    print(f"[INF]: out_json ={out_json}")
+
+    lib = scan_gds(in_gds)
+    write_index(lib, out_json)
+    print(f"[INF]: {len(lib['cells'])} cells, top cells={len(lib['top_cells'])}")
+
+#EOF
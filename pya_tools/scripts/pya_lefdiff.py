@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#===================================================================
+# This file is associated with the pya_toos project.
+# Copyright (C) 2025 Logic-Research K.K. (Author: MATSUDA Masahiro)
+#
+# This script file is licensed under the MIT License.
+#===================================================================
+# compare two macro LEF files geometrically.
+#   - PIN/OBS shapes are compared per macro, pin and layer by XOR of the rect unions
+#     (differences only in rect splitting are not reported)
+#   - other statements (SIZE, FOREIGN, ANTENNA*, DIRECTION, ...) are compared
+#     as tokens, numbers with tolerance
+#===================================================================
+import pya
+import os, sys, json, re
+from collections import OrderedDict
+
+# ------------------------
+# functions
+# ------------------------
+def tokenize_lef(path: str) -> list:
+    """
+    LEFファイルをtokenのリストへ変換(コメント削除、";"は1token)
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    text = re.sub(r"#[^\n]*", "", text)
+    return text.replace(";", " ; ").split()
+
+def parse_statement(tokens: list, i: int) -> tuple:
+    """
+    tokens[i]から";"までの1文を返す: (文のtokenリスト, 次の位置)
+    """
+    j = i
+    while j < len(tokens) and tokens[j] != ";":
+        j += 1
+    return tokens[i:j], j + 1
+
+GEOMETRY_KEYWORDS = ("LAYER", "RECT", "POLYGON", "PATH", "VIA")
+
+def parse_geometry(tokens: list, i: int, shapes: dict) -> int:
+    """
+    PORT/OBSの中身("END"まで)を読み、shapes({layer: [RECT(x1,y1,x2,y2) / POLYGON点列]})へ追加
+    pya_gds2lefはPORT内のLAYER毎に"END"を出力するため、"END"の後に図形の文が続く場合は読み続ける
+    """
+    layer = None
+    while i < len(tokens):
+        if tokens[i] == "END":
+            if i + 1 < len(tokens) and tokens[i+1] in GEOMETRY_KEYWORDS:
+                i += 1
+                continue
+            break
+        stmt, i = parse_statement(tokens, i)
+        if not stmt:
+            continue
+        if stmt[0] == "LAYER":
+            layer = stmt[1]
+            shapes.setdefault(layer, [])
+        elif stmt[0] in ("RECT", "POLYGON") and layer is not None:
+            values = stmt[1:]
+            if values and values[0] == "MASK":
+                values = values[2:]
+            shapes[layer].append([float(v) for v in values])
+    return i + 1
+
+def parse_lef(path: str) -> tuple:
+    """
+    macro LEFを読み込む
+      戻り値: (macros, database_microns)
+        macros: {macro名: {"stmts": [...], "pins": {pin名: {"stmts": [...], "shapes": {layer: [...]}}}, "obs": {layer: [...]}}}
+    """
+    tokens  = tokenize_lef(path)
+    macros  = OrderedDict()
+    microns = None
+    i = 0
+    while i < len(tokens):
+        tok = tokens[i]
+        if tok == "MACRO":
+            name  = tokens[i+1]
+            macro = {"stmts": [], "pins": OrderedDict(), "obs": {}}
+            i += 2
+            while i < len(tokens) and not (tokens[i] == "END" and tokens[i+1] == name):
+                if tokens[i] == "PIN":
+                    pin_name = tokens[i+1]
+                    pin = {"stmts": [], "shapes": {}}
+                    i += 2
+                    while i < len(tokens) and not (tokens[i] == "END" and tokens[i+1] == pin_name):
+                        if tokens[i] == "PORT":
+                            i = parse_geometry(tokens, i + 1, pin["shapes"])
+                        else:
+                            stmt, i = parse_statement(tokens, i)
+                            pin["stmts"].append(stmt)
+                    macro["pins"][pin_name] = pin
+                    i += 2
+                elif tokens[i] == "OBS":
+                    i = parse_geometry(tokens, i + 1, macro["obs"])
+                else:
+                    stmt, i = parse_statement(tokens, i)
+                    macro["stmts"].append(stmt)
+            macros[name] = macro
+            i += 2
+        elif tok == "DATABASE" and tokens[i+1] == "MICRONS":
+            microns = int(tokens[i+2])
+            i += 3
+        elif tok == "END" and i + 1 < len(tokens) and tokens[i+1] == "LIBRARY":
+            break
+        else:
+            i += 1
+    return macros, microns
+
+def to_number(token: str):
+    try:
+        return float(token)
+    except ValueError:
+        return None
+
+def compare_statements(stmts1: list, stmts2: list, tol: float) -> list:
+    """
+    文のリストを順不同で比較(数値はtol以内なら一致)。差分の説明のリストを返す
+    """
+    def keyed(stmts):
+        groups = {}
+        for stmt in stmts:
+            numbers = [to_number(t) for t in stmt]
+            key = tuple(t if n is None else "#" for t, n in zip(stmt, numbers))
+            groups.setdefault(key, []).append([n for n in numbers if n is not None])
+        return groups
+
+    diffs = []
+    if stmts1 == stmts2:
+        return diffs
+    g1, g2 = keyed(stmts1), keyed(stmts2)
+    for key in sorted(set(g1) | set(g2)):
+        v1 = sorted(g1.get(key, []))
+        v2 = sorted(g2.get(key, []))
+        label = " ".join(key).replace("#", "*")
+        if len(v1) != len(v2):
+            diffs.append(f"{label} : count {len(v1)} != {len(v2)}")
+            continue
+        for a, b in zip(v1, v2):
+            if any(abs(x - y) > tol for x, y in zip(a, b)):
+                diffs.append(f"{label} : {a} != {b}")
+    return diffs
+
+def to_region(polygons: list, microns: int) -> pya.Region:
+    """
+    RECT/POLYGON点列(um)のリストを整数DBUのregion(merge済)へ変換
+    """
+    region = pya.Region()
+    for coords in polygons:
+        if len(coords) == 4:
+            region.insert(pya.Box(*[round(v * microns) for v in coords]))
+            continue
+        points = [pya.Point(round(coords[k] * microns), round(coords[k+1] * microns)) for k in range(0, len(coords), 2)]
+        region.insert(pya.Polygon(points))
+    region.merge()
+    return region
+
+def compare_shapes(shapes1: dict, shapes2: dict, microns: int) -> list:
+    """
+    レイヤ毎にregionのXORで比較。差分の説明のリストを返す
+    """
+    diffs = []
+    for layer in sorted(set(shapes1) | set(shapes2)):
+        if shapes1.get(layer) == shapes2.get(layer):
+            continue
+        r1 = to_region(shapes1.get(layer, []), microns)
+        r2 = to_region(shapes2.get(layer, []), microns)
+        xor = r1 ^ r2
+        if not xor.is_empty():
+            area = xor.area() / (microns * microns)
+            box  = xor.bbox()
+            diffs.append(f"LAYER {layer} : XOR area {area:.6f} um2 at ({box.left/microns:.3f} {box.bottom/microns:.3f} {box.right/microns:.3f} {box.top/microns:.3f})")
+    return diffs
+
+def compare_macro(m1: dict, m2: dict, microns: int, tol: float) -> list:
+    """
+    1つのMACROを比較。差分の説明のリストを返す
+    """
+    diffs = [d for d in compare_statements(m1["stmts"], m2["stmts"], tol)]
+
+    for pin_name in list(m1["pins"]) + [p for p in m2["pins"] if p not in m1["pins"]]:
+        p1 = m1["pins"].get(pin_name)
+        p2 = m2["pins"].get(pin_name)
+        if p1 is None or p2 is None:
+            diffs.append(f"PIN {pin_name} : only in {'lef1' if p2 is None else 'lef2'}")
+            continue
+        diffs.extend(f"PIN {pin_name} {d}" for d in compare_statements(p1["stmts"], p2["stmts"], tol))
+        diffs.extend(f"PIN {pin_name} {d}" for d in compare_shapes(p1["shapes"], p2["shapes"], microns))
+
+    diffs.extend(f"OBS {d}" for d in compare_shapes(m1["obs"], m2["obs"], microns))
+    return diffs
+
+def compare_macros(names: list, macros1: dict, macros2: dict, microns: int, tol: float) -> dict:
+    """
+    namesのMACROを比較: {macro名: 差分の説明のリスト}(差分があるもののみ)
+    """
+    result = {}
+    for name in names:
+        diffs = compare_macro(macros1[name], macros2[name], microns, tol)
+        if diffs:
+            result[name] = diffs
+    return result
+
+def compare_macros_parallel(names: list, macros1: dict, macros2: dict, microns: int, tol: float, n_jobs: int) -> dict:
+    """
+    compare_macrosをn_jobs個の子プロセス(fork)に分けて実行
+    """
+    if n_jobs <= 1 or len(names) < 2 or not hasattr(os, "fork"):
+        return compare_macros(names, macros1, macros2, microns, tol)
+
+    children = []
+    for k in range(min(n_jobs, len(names))):
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            code = 0
+            try:
+                with os.fdopen(w, "w", encoding="utf-8") as f:
+                    json.dump(compare_macros(names[k::n_jobs], macros1, macros2, microns, tol), f)
+            except BaseException:
+                code = 1
+            os._exit(code)
+        os.close(w)
+        children.append((pid, r))
+
+    result = {}
+    for pid, r in children:
+        with os.fdopen(r, "r", encoding="utf-8") as f:
+            data = f.read()
+        _, status = os.waitpid(pid, 0)
+        if status != 0 or not data:
+            raise RuntimeError(f"child process {pid} failed.")
+        result.update(json.loads(data))
+    return result
+
+def lefdiff(lef1: str, lef2: str, microns: int=0, tol: float=0.001, n_jobs: int=0) -> dict:
+    """
+    2つのmacro LEFを比較
+      戻り値: {"only1": [...], "only2": [...], "diffs": {macro名: [差分の説明]}, "n_macros": 比較したMACRO数}
+    """
+    macros1, microns1 = parse_lef(lef1)
+    macros2, microns2 = parse_lef(lef2)
+    if not microns:
+        microns = microns1 or microns2 or 1000
+    if n_jobs <= 0:
+        n_jobs = os.cpu_count() or 1
+
+    common = [n for n in macros1 if n in macros2]
+    diffs  = compare_macros_parallel(common, macros1, macros2, microns, tol, n_jobs)
+    return {
+        "only1"   : [n for n in macros1 if n not in macros2],
+        "only2"   : [n for n in macros2 if n not in macros1],
+        "diffs"   : OrderedDict((n, diffs[n]) for n in common if n in diffs),
+        "n_macros": len(common),
+    }
+
+# ------------------------
+# klayout(main)
+# ------------------------
+# argument is given from klayout -rd <name>=<value> options.
+#  ex) klayout -b -r pya_lefdiff.py -rd lef1=ref_macro.lef -rd lef2=new_macro.lef
+#lef1="ref_macro.lef"
+#lef2="new_macro.lef"
+#tol=0.001       # tolerance of numbers(SIZE, ANTENNA*, ...)
+#microns=1000    # database units per micron(default: DATABASE MICRONS in LEF, or 1000)
+#jobs=0          # number of processes(0: number of CPUs)
+
+if __name__ == "__main__":
+    if 'lef1' not in globals() or 'lef2' not in globals():
+        print(f"[ERROR]: -rd lef1=<file> and -rd lef2=<file> are required.", file=sys.stderr)
+        sys.exit(1)
+    for f in (lef1, lef2):
+        if not os.path.isfile(f):
+            print(f"[ERROR]: Input file '{f}' does not exist.", file=sys.stderr)
+            sys.exit(1)
+    if 'tol' not in globals():
+        tol = 0.001
+    if 'microns' not in globals():
+        microns = 0
+    if 'jobs' not in globals():
+        jobs = 0
+
+    print(f"[INFO]: lef1={lef1}")
+    print(f"[INFO]: lef2={lef2}")
+
+    result = lefdiff(lef1, lef2, microns=int(microns), tol=float(tol), n_jobs=int(jobs))
+    for name in result["only1"]:
+        print(f"[DIFF]: MACRO {name} : only in lef1")
+    for name in result["only2"]:
+        print(f"[DIFF]: MACRO {name} : only in lef2")
+    for name, diffs in result["diffs"].items():
+        for d in diffs:
+            print(f"[DIFF]: MACRO {name} {d}")
+
+    n_diff = len(result["only1"]) + len(result["only2"]) + len(result["diffs"])
+    print(f"[INFO]: {result['n_macros']} macros compared, {n_diff} macros differ.")
+    sys.exit(1 if n_diff else 0)
+
+#EOF
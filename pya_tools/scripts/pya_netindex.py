@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#===================================================================
+# This file is associated with the pya_toos project.
+# Copyright (C) 2025 LogicResearch K.K (Author: MATSUDA Masahiro)
+#
+# This script file is licensed under the MIT License.
+#===================================================================
+# search device/net records in SPICE netlist using the index(ofile.idx)
+# written by pya_flatspice (-rd index=1).
+#
+# index format (little endian):
+#   header  : magic(8s) n_files(I) n_keys(I) files_off(Q) keys_off(Q) names_off(Q) postings_off(Q)
+#   files   : json list of netlist file names (relative to the index file)
+#   keys    : (n_keys+1) x (name_off(I) postings_off(I)), sorted by name
+#             (key i is names[name_off(i):name_off(i+1)], postings[postings_off(i):postings_off(i+1)])
+#   names   : key names ("D:<device name>" or "N:<net name>")
+#   postings: per key, ascending (file_no << 40 | byte offset of the statement),
+#             the first one as is and the rest as deltas, in varint(LEB128)
+#===================================================================
+import os, sys, json, mmap, struct
+
+INDEX_MAGIC        = b"PYANIDX2"
+INDEX_HEADER       = struct.Struct("<8sIIQQQQ")
+INDEX_ENTRY        = struct.Struct("<II")
+INDEX_OFFSET_BITS  = 40
+
+KIND_PREFIX = {"device": b"D:", "net": b"N:"}
+
+# ------------------------
+# functions
+# ------------------------
+def decode_postings(data: bytes) -> list:
+    """
+    差分のvarint(LEB128)からpostingのリストへ戻す
+    """
+    result = []
+    p = d = shift = 0
+    for b in data:
+        d |= (b & 0x7f) << shift
+        if b & 0x80:
+            shift += 7
+        else:
+            p += d
+            result.append(p)
+            d = shift = 0
+    return result
+
+class NetIndex:
+    """
+    pya_flatspiceが作成したindexファイルを検索
+      ex) with NetIndex("top_flat.spice.idx") as idx:
+            for rec in idx.lookup("M1.2.1", kind="device"): print(rec)
+    """
+    def __init__(self, path: str):
+        self.path     = path
+        self.base_dir = os.path.dirname(os.path.abspath(path))
+        self.fp = open(path, "rb")
+        self.mm = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, n_files, self.n_keys, files_off, self.keys_off, self.names_off, self.postings_off = INDEX_HEADER.unpack_from(self.mm, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"'{path}' is not a pya_flatspice index file.")
+
+        self.files = json.loads(self.mm[files_off:self.keys_off].decode())
+
+    def close(self):
+        self.mm.close()
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _entry(self, i: int) -> tuple:
+        """
+        i番目のkeyの(名前, postingsの範囲(postings_offからのbyte位置))
+        """
+        pos = self.keys_off + i * INDEX_ENTRY.size
+        name_off, start = INDEX_ENTRY.unpack_from(self.mm, pos)
+        name_end, end   = INDEX_ENTRY.unpack_from(self.mm, pos + INDEX_ENTRY.size)
+        return self.mm[self.names_off + name_off:self.names_off + name_end], start, end
+
+    def _lower_bound(self, key: bytes) -> int:
+        """
+        key以上となる最初のkeyの位置(二分探索)
+        """
+        lo, hi = 0, self.n_keys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def offsets(self, name: str, kind: str="device") -> list:
+        """
+        name(device名/net名)の(ファイル名, byte offset)のリスト
+        """
+        for n in (name, name.upper()):
+            key = KIND_PREFIX[kind] + n.encode()
+            i = self._lower_bound(key)
+            if i < self.n_keys:
+                k, start, end = self._entry(i)
+                if k == key:
+                    postings = decode_postings(self.mm[self.postings_off + start:self.postings_off + end])
+                    return [(self.files[p >> INDEX_OFFSET_BITS], p & ((1 << INDEX_OFFSET_BITS) - 1)) for p in postings]
+        return []
+
+    def names(self, prefix: str, kind: str="device", limit: int=1000) -> list:
+        """
+        prefixで始まるdevice名/net名のリスト(最大limit個)
+        """
+        key = KIND_PREFIX[kind] + prefix.encode()
+        result = []
+        i = self._lower_bound(key)
+        while i < self.n_keys and len(result) < limit:
+            k = self._entry(i)[0]
+            if not k.startswith(key):
+                break
+            result.append(k[2:].decode())
+            i += 1
+        return result
+
+    def read_record(self, file: str, offset: int) -> str:
+        """
+        fileのoffsetから1文(継続行を含む)を読む
+        """
+        lines = []
+        with open(os.path.join(self.base_dir, file), "rb") as f:
+            f.seek(offset)
+            for line in f:
+                if lines and not line.startswith(b"+"):
+                    break
+                lines.append(line.decode().rstrip("\r\n"))
+        return "\n".join(lines)
+
+    def lookup(self, name: str, kind: str="device") -> list:
+        """
+        name(device名/net名)を含む文のリスト
+        """
+        return [self.read_record(f, o) for f, o in self.offsets(name, kind)]
+
+# ------------------------
+# klayout(main)
+# ------------------------
+# argument is given from klayout -rd <name>=<value> options.
+#  ex) klayout -b -r pya_netindex.py -rd index=top_flat.spice.idx -rd name=M1.2.1 -rd kind=device
+#index="top_flat.spice.idx"
+#name="M1.2.1"
+#kind="device"    # device or net
+#prefix=0         # 1: list names starting with name
+
+if __name__ == "__main__":
+    if 'index' not in globals() or 'name' not in globals():
+        print(f"[ERROR]: -rd index=<file> and -rd name=<name> are required.", file=sys.stderr)
+        sys.exit(1)
+    if 'kind' not in globals():
+        kind = "device"
+    if 'prefix' not in globals():
+        prefix = 0
+
+    if kind not in KIND_PREFIX:
+        print(f"[ERROR]: kind must be device or net. ({kind})", file=sys.stderr)
+        sys.exit(1)
+
+    with NetIndex(index) as idx:
+        if str(prefix) not in ("0", ""):
+            for n in idx.names(name, kind):
+                print(n)
+        else:
+            records = idx.lookup(name, kind)
+            if not records:
+                print(f"[ERROR]: {kind} '{name}' is not found.", file=sys.stderr)
+                sys.exit(1)
+            for rec in records:
+                print(rec)
+
+#EOF